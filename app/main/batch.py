@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+import numpy as np
+from .config import openmeteo, setup_logging, FORECAST_URL, BATCH_SIZE, BATCH_CONCURRENCY
+from .grid import snap_point
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+LATEST_FIELDS = ("temperature", "wind_speed", "pressure")
+LATEST_VARIABLES = "temperature_2m,wind_speed_10m,pressure_msl"
+
+
+def latest_params(latitude, longitude):
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "current": LATEST_VARIABLES,
+        "hourly": LATEST_VARIABLES,
+        "past_hours": 1,
+        "forecast_hours": 2
+    }
+
+
+def nearest_index(times, now):
+    index = int(np.searchsorted(times, now))
+    if index == 0:
+        return 0
+    if index >= len(times):
+        return len(times) - 1
+    if times[index] - now < now - times[index - 1]:
+        return index
+    return index - 1
+
+
+def hourly_times(hourly, count):
+    return hourly.Time() + hourly.Interval() * np.arange(count)
+
+
+def parse_latest(response, now=None):
+    current = response.Current()
+    if current is not None:
+        return {
+            field: current.Variables(i).Value()
+            for i, field in enumerate(LATEST_FIELDS)
+        }
+
+    hourly = response.Hourly()
+    values = [hourly.Variables(i).ValuesAsNumpy()
+              for i in range(len(LATEST_FIELDS))]
+    times = hourly_times(hourly, len(values[0]))
+    index = nearest_index(times, time.time() if now is None else now)
+    return {
+        field: values[i][index] for i, field in enumerate(LATEST_FIELDS)
+    }
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def fetch_chunk(coordinates):
+    params = latest_params(
+        ",".join(str(latitude) for latitude, _ in coordinates),
+        ",".join(str(longitude) for _, longitude in coordinates))
+
+    try:
+        responses = await openmeteo.weather_api(FORECAST_URL, params=params)
+        logger.debug(f"Пакет получен для {len(coordinates)} координат")
+        return {
+            coords: parse_latest(response)
+            for coords, response in zip(coordinates, responses)
+        }
+    except Exception as e:
+        logger.error(
+            f"Ошибка при получении пакета для {len(coordinates)} координат: {e}")
+        return {}
+
+
+async def iter_weather_chunks(
+        coordinates,
+        batch_size=BATCH_SIZE,
+        concurrency=BATCH_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(chunk):
+        async with semaphore:
+            return chunk, await fetch_chunk(chunk)
+
+    for future in asyncio.as_completed(
+            [fetch(chunk) for chunk in chunked(coordinates, batch_size)]):
+        yield await future
+
+
+async def fetch_weather_batch(
+        cities,
+        batch_size=BATCH_SIZE,
+        concurrency=BATCH_CONCURRENCY):
+    points = {
+        city.id: snap_point(city.latitude, city.longitude) for city in cities}
+    coordinates = list(dict.fromkeys(points.values()))
+
+    weather = {}
+    async for _, result in iter_weather_chunks(
+            coordinates, batch_size, concurrency):
+        weather.update(result)
+
+    return {city.id: weather.get(points[city.id]) for city in cities}
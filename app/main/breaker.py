@@ -0,0 +1,60 @@
+import time
+from .executor import UpstreamBusy
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(UpstreamBusy):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.opened = 0
+        self.rejected = 0
+
+    def check(self):
+        now = self.clock()
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.probe_at = None
+
+        probing = (self.probe_at is not None
+                   and now - self.probe_at < self.cooldown)
+        if self.state == OPEN or (self.state == HALF_OPEN and probing):
+            self.rejected += 1
+            raise CircuitOpen("Open-Meteo недоступен, запросы временно приостановлены")
+
+        if self.state == HALF_OPEN:
+            self.probe_at = now
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened += 1
+            self.state = OPEN
+            self.opened_at = self.clock()
+            self.probe_at = None
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,82 @@
+import json
+import logging
+from .batch import iter_weather_chunks
+from .executor import use_lane, BACKGROUND
+from .config import setup_logging, BATCH_SIZE, BATCH_CONCURRENCY, BULK_MAX_POINTS
+from .grid import snap_point
+from .snapshots import to_float
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+def parse_points(body, max_points=BULK_MAX_POINTS):
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Некорректный JSON.")
+
+    if isinstance(data, dict):
+        data = data.get("points")
+    if not isinstance(data, list) or not data:
+        raise ValueError("Ожидается непустой список координат.")
+    if len(data) > max_points:
+        raise ValueError(f"Не более {max_points} точек в одном запросе.")
+    return data
+
+
+def read_point(item):
+    if isinstance(item, dict):
+        latitude, longitude = item.get("latitude"), item.get("longitude")
+    elif isinstance(item, list) and len(item) == 2:
+        latitude, longitude = item
+    else:
+        return None
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+
+def ndjson(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def chunk_lines(cells, chunk, weather):
+    lines = []
+    for cell in chunk:
+        data = weather.get(cell)
+        for index, (latitude, longitude) in cells[cell]:
+            record = {"index": index, "latitude": latitude, "longitude": longitude}
+            if data is None:
+                record["error"] = "Не удалось получить данные о погоде."
+            else:
+                record["weather"] = {
+                    key: to_float(value) for key, value in data.items()}
+            lines.append(ndjson(record))
+    return "".join(lines)
+
+
+async def bulk_lines(
+        points,
+        batch_size=BATCH_SIZE,
+        concurrency=BATCH_CONCURRENCY):
+    cells = {}
+    for index, item in enumerate(points):
+        point = read_point(item)
+        if point is None:
+            yield ndjson({"index": index, "error": "Некорректные координаты."})
+            continue
+        cells.setdefault(snap_point(*point), []).append((index, point))
+
+    logger.debug(f"Пакетный запрос: {len(points)} точек, {len(cells)} ячеек")
+
+    with use_lane(BACKGROUND):
+        chunks = iter_weather_chunks(list(cells), batch_size, concurrency)
+        async for chunk, weather in chunks:
+            yield chunk_lines(cells, chunk, weather)
+
@@ -0,0 +1,94 @@
+import logging
+from django.db import transaction
+from .config import setup_logging, CITY_TOLERANCE
+from .fragments import invalidate_user
+from .grid import cell_key, neighbour_keys
+from .models import City, UserCity
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+def distance(city, latitude, longitude):
+    return max(abs(city.latitude - latitude), abs(city.longitude - longitude))
+
+
+def nearest_city(candidates, latitude, longitude, tolerance=CITY_TOLERANCE):
+    best = None
+    for city in candidates:
+        if distance(city, latitude, longitude) > tolerance:
+            continue
+        if best is None or (distance(city, latitude, longitude)
+                            < distance(best, latitude, longitude)):
+            best = city
+    return best
+
+
+def find_city(latitude, longitude, tolerance=CITY_TOLERANCE):
+    candidates = City.objects.filter(
+        location_key__in=neighbour_keys(latitude, longitude, tolerance))
+    return nearest_city(candidates, latitude, longitude, tolerance)
+
+
+async def afind_city(latitude, longitude, tolerance=CITY_TOLERANCE):
+    candidates = [city async for city in City.objects.filter(
+        location_key__in=neighbour_keys(latitude, longitude, tolerance))]
+    return nearest_city(candidates, latitude, longitude, tolerance)
+
+
+def group_duplicates(cities, tolerance=CITY_TOLERANCE):
+    cells = {}
+    duplicates = {}
+    for city in sorted(cities, key=lambda city: city.id):
+        candidates = [
+            canonical
+            for key in neighbour_keys(city.latitude, city.longitude, tolerance)
+            for canonical in cells.get(key, [])]
+        canonical = nearest_city(
+            candidates, city.latitude, city.longitude, tolerance)
+        if canonical is None:
+            cells.setdefault(
+                cell_key(city.latitude, city.longitude, tolerance), []).append(city)
+        else:
+            duplicates[city.id] = canonical.id
+    return duplicates
+
+
+@transaction.atomic
+def merge_duplicates(tolerance=CITY_TOLERANCE, dry_run=False):
+    cities = list(City.objects.filter(
+        latitude__isnull=False, longitude__isnull=False))
+    duplicates = group_duplicates(cities, tolerance)
+    if dry_run:
+        return duplicates
+
+    for city in cities:
+        city.location_key = cell_key(
+            city.latitude, city.longitude, CITY_TOLERANCE)
+    City.objects.bulk_update(cities, ['location_key'], batch_size=500)
+
+    canonical_ids = set(duplicates.values())
+    followed = set(UserCity.objects.filter(
+        city_id__in=canonical_ids).values_list('user_id', 'city_id'))
+    repointed = []
+    users = set()
+    for user_city in UserCity.objects.filter(
+            city_id__in=duplicates).select_related('city'):
+        user_city.name = user_city.label
+        user_city.city_id = duplicates[user_city.city_id]
+        users.add(user_city.user_id)
+        if (user_city.user_id, user_city.city_id) not in followed:
+            followed.add((user_city.user_id, user_city.city_id))
+            repointed.append(user_city)
+
+    UserCity.objects.filter(city_id__in=duplicates).exclude(
+        id__in=[user_city.id for user_city in repointed]).delete()
+    UserCity.objects.bulk_update(repointed, ['city', 'name'], batch_size=500)
+    City.objects.filter(id__in=duplicates).delete()
+
+    for user_id in users:
+        transaction.on_commit(lambda user_id=user_id: invalidate_user(user_id))
+    logger.info(
+        f"Объединено дубликатов городов: {len(duplicates)}, "
+        f"перенесено записей пользователей: {len(repointed)}")
+    return duplicates
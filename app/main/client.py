@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+import requests
+from openmeteo_requests.Client import OpenMeteoRequestsError
+from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+from requests.structures import CaseInsensitiveDict
+from requests_cache import CachedResponse
+from requests_cache.models import CachedRequest
+from .coalesce import SingleFlight
+from .breaker import CircuitBreaker
+from .executor import UpstreamExecutor, upstream_lane, INTERACTIVE
+from .memcache import hit_ratio
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (500, 502, 504)
+
+
+def is_upstream_failure(status):
+    return status == 429 or status >= 500
+
+
+def encode_params(params):
+    encoded = {}
+    for key, value in params.items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(item) for item in value)
+        encoded[key] = str(value)
+    encoded["format"] = "flatbuffers"
+    return encoded
+
+
+def decode_messages(data):
+    messages = []
+    total = len(data)
+    pos = 0
+    while pos < total:
+        length = int.from_bytes(data[pos:pos + 4], byteorder="little")
+        messages.append(WeatherApiResponse.GetRootAs(data, pos + 4))
+        pos += length + 4
+    return messages
+
+
+class AsyncClient:
+    def __init__(
+            self,
+            cache=None,
+            expire_after=15 * 60,
+            retries=5,
+            backoff_factor=0.2,
+            limit_per_host=20,
+            keepalive_timeout=60,
+            timeout=30,
+            interactive_retries=1,
+            interactive_timeout=5,
+            executor=None,
+            breaker=None,
+            io_workers=4):
+        self.cache = cache
+        self.expire_after = expire_after
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.interactive_retries = interactive_retries
+        self.interactive_timeout = interactive_timeout
+        self._sessions = weakref.WeakKeyDictionary()
+        self.flights = SingleFlight()
+        self.executor = executor or UpstreamExecutor()
+        self.breaker = breaker or CircuitBreaker()
+        self.io_pool = ThreadPoolExecutor(
+            max_workers=io_workers, thread_name_prefix="upstream-cache")
+        self.hits = 0
+        self.misses = 0
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _cache_key(self, url, params):
+        prepared = requests.Request('GET', url, params=params).prepare()
+        return prepared, self.cache.create_key(prepared)
+
+    def _load_cached(self, url, params):
+        prepared, key = self._cache_key(url, params)
+        cached = self.cache.get_response(key)
+        if cached is None or cached.is_expired:
+            return None
+        return cached.content
+
+    def _save_cached(self, url, params, headers, body):
+        prepared, key = self._cache_key(url, params)
+        response = CachedResponse(
+            status_code=200,
+            url=prepared.url,
+            headers=CaseInsensitiveDict(headers),
+            request=CachedRequest.from_request(prepared),
+            expires=datetime.now(timezone.utc) + timedelta(seconds=self.expire_after))
+        response._content = body
+        self.cache.responses[key] = response
+
+    def attempt_limits(self):
+        if upstream_lane.get() == INTERACTIVE:
+            return (min(self.retries, self.interactive_retries),
+                    min(self.timeout, self.interactive_timeout))
+        return self.retries, self.timeout
+
+    async def _request(self, url, params):
+        retries, timeout = self.attempt_limits()
+        for attempt in range(retries + 1):
+            self.breaker.check()
+            try:
+                async with self.session().get(
+                        url, params=params,
+                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    if is_upstream_failure(response.status):
+                        self.breaker.record_failure()
+                    if response.status in (400, 429):
+                        if response.status == 400:
+                            self.breaker.record_success()
+                        raise OpenMeteoRequestsError(await response.json())
+                    if response.status in RETRY_STATUSES and attempt < retries:
+                        logger.warning(
+                            f"Ответ {response.status} от {url}, повтор {attempt + 1}")
+                    else:
+                        response.raise_for_status()
+                        body = await response.read()
+                        self.breaker.record_success()
+                        return dict(response.headers), body
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                logger.warning(f"Ошибка соединения с {url}: {e}, повтор {attempt + 1}")
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def _in_pool(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_pool, func, *args)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.flights.coalesced,
+            "hit_ratio": hit_ratio(self.hits, self.misses),
+        }
+
+    async def weather_api(self, url, params):
+        params = encode_params(params)
+        key = (url, tuple(sorted(params.items())))
+        return await self.flights.run(key, lambda: self._fetch(url, params))
+
+    async def _fetch(self, url, params):
+        if self.cache is not None:
+            try:
+                body = await self._in_pool(self._load_cached, url, params)
+            except Exception as e:
+                logger.error(f"Ошибка при чтении ответа из кеша: {e}")
+                body = None
+            if body is not None:
+                self.hits += 1
+                return decode_messages(body)
+
+        self.misses += 1
+        headers, body = await self.executor.run(
+            lambda: self._request(url, params))
+
+        if self.cache is not None:
+            try:
+                await self._in_pool(self._save_cached, url, params, headers, body)
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении ответа в кеш: {e}")
+
+        return decode_messages(body)
@@ -0,0 +1,23 @@
+import asyncio
+import weakref
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight = weakref.WeakKeyDictionary()
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key, func):
+        flights = self._inflight.setdefault(asyncio.get_running_loop(), {})
+        task = flights.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func())
+            flights[key] = task
+            task.add_done_callback(lambda _: flights.pop(key, None))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
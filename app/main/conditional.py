@@ -0,0 +1,30 @@
+import hashlib
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def conditional_json(request, payload, last_modified=None, age=None):
+    body = json.dumps(
+        payload, cls=DjangoJSONEncoder, separators=(",", ":")).encode()
+    etag = make_etag(body)
+    timestamp = None if last_modified is None else int(last_modified.timestamp())
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = HttpResponse(body, content_type="application/json")
+
+    response["ETag"] = etag
+    if timestamp is not None:
+        response["Last-Modified"] = http_date(timestamp)
+    if age is not None:
+        response["Age"] = str(age)
+    response["Cache-Control"] = "private, no-cache"
+    return response
@@ -1,7 +1,10 @@
 import logging
-import openmeteo_requests
 import requests_cache
-from retry_requests import retry
+from .client import AsyncClient
+from .breaker import CircuitBreaker
+from .executor import UpstreamExecutor
+from .memcache import TTLCache
+from .shared import SharedForecastCache
 
 
 def setup_logging():
@@ -11,6 +14,71 @@ def setup_logging():
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 
 
-cache_session = requests_cache.CachedSession('.cache', expire_after=15 * 60)
-retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-openmeteo = openmeteo_requests.Client(session=retry_session)
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+BATCH_SIZE = 50
+BATCH_CONCURRENCY = 4
+BULK_MAX_POINTS = 10000
+GRID_STEP = 0.05
+CITY_TOLERANCE = 0.01
+SPATIAL_BUCKET = 0.1
+NEAREST_MAX_DISTANCE = 5.0
+SPATIAL_SYNC_INTERVAL = 60
+CACHE_EXPIRE = 15 * 60
+MEMORY_CACHE_SIZE = 1024
+HISTORY_CACHE_SIZE = 100000
+HISTORY_CACHE_TTL = 24 * 60 * 60
+HISTORY_DIR = 'history'
+STREAM_CHUNK_ROWS = 500
+INDEX_FRAGMENT_TTL = 15 * 60
+INDEX_DEADLINE = 1.5
+TILE_DEADLINE = 10
+ARCHIVE_LAG_DAYS = 5
+HISTORY_VARIABLES = [
+    "temperature_2m", "relative_humidity_2m", "dew_point_2m",
+    "apparent_temperature", "precipitation", "rain", "snowfall",
+    "snow_depth", "weather_code", "pressure_msl", "surface_pressure",
+    "cloud_cover", "cloud_cover_low", "cloud_cover_mid", "cloud_cover_high",
+    "et0_fao_evapotranspiration", "vapour_pressure_deficit",
+    "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m",
+]
+REFRESH_INTERVAL = 15 * 60
+REFRESH_SLOTS = 30
+REFRESH_WORKERS = 4
+LEADER_LOCK_PATH = '.refresh.lock'
+LEADER_RETRY_INTERVAL = 30
+SNAPSHOT_MAX_AGE = 20 * 60
+UPSTREAM_CONCURRENCY = 16
+UPSTREAM_RESERVED = 4
+UPSTREAM_MAX_QUEUE = 32
+UPSTREAM_BACKGROUND_QUEUE = 256
+UPSTREAM_RETRY_AFTER = 5
+UPSTREAM_RETRIES = 5
+UPSTREAM_TIMEOUT = 30
+INTERACTIVE_RETRIES = 1
+INTERACTIVE_TIMEOUT = 5
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+STALE_MAX_AGE = 6 * 60 * 60
+SHARED_CACHE_PATH = '.forecast.cache'
+SHARED_CACHE_SLOTS = 16384
+
+cache_session = requests_cache.CachedSession('.cache', expire_after=CACHE_EXPIRE)
+openmeteo = AsyncClient(
+    cache=cache_session.cache,
+    expire_after=CACHE_EXPIRE,
+    retries=UPSTREAM_RETRIES,
+    backoff_factor=0.2,
+    limit_per_host=20,
+    timeout=UPSTREAM_TIMEOUT,
+    interactive_retries=INTERACTIVE_RETRIES,
+    interactive_timeout=INTERACTIVE_TIMEOUT,
+    executor=UpstreamExecutor(
+        UPSTREAM_CONCURRENCY,
+        UPSTREAM_RESERVED,
+        UPSTREAM_MAX_QUEUE,
+        UPSTREAM_BACKGROUND_QUEUE),
+    breaker=CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN))
+memory_cache = TTLCache(MEMORY_CACHE_SIZE, CACHE_EXPIRE)
+last_good_cache = TTLCache(MEMORY_CACHE_SIZE, STALE_MAX_AGE)
+forecast_cache = SharedForecastCache(SHARED_CACHE_PATH, SHARED_CACHE_SLOTS, GRID_STEP)
@@ -0,0 +1,32 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from .live import city_group
+from .models import UserCity
+
+
+class WeatherConsumer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.city_groups = [
+            city_group(city_id) for city_id in await self.get_city_ids(user)]
+        for group in self.city_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        for group in getattr(self, 'city_groups', []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def weather_update(self, event):
+        await self.send_json({
+            "city": event["city"],
+            "weather": event["weather"],
+            "fetched_at": event["fetched_at"],
+        })
+
+    async def get_city_ids(self, user):
+        return [city_id async for city_id in UserCity.objects.filter(
+            user=user).values_list('city_id', flat=True)]
@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BACKGROUND)
+
+upstream_lane = contextvars.ContextVar("upstream_lane", default=INTERACTIVE)
+
+
+@contextmanager
+def use_lane(lane):
+    token = upstream_lane.set(lane)
+    try:
+        yield
+    finally:
+        upstream_lane.reset(token)
+
+
+class UpstreamBusy(Exception):
+    pass
+
+
+class UpstreamExecutor:
+    def __init__(
+            self,
+            concurrency=16,
+            reserved=4,
+            max_queue=32,
+            background_queue=256):
+        self.concurrency = concurrency
+        self.limits = {
+            INTERACTIVE: concurrency,
+            BACKGROUND: max(1, concurrency - reserved),
+        }
+        self.max_queue = {INTERACTIVE: max_queue, BACKGROUND: background_queue}
+        self.active = {lane: 0 for lane in LANES}
+        self.waiters = {lane: deque() for lane in LANES}
+        self.waited = {lane: 0 for lane in LANES}
+        self.wait_total = {lane: 0.0 for lane in LANES}
+        self.wait_max = {lane: 0.0 for lane in LANES}
+        self.rejected = {lane: 0 for lane in LANES}
+
+    def available(self, lane):
+        return (sum(self.active.values()) < self.concurrency
+                and self.active[lane] < self.limits[lane])
+
+    def record_wait(self, lane, started):
+        wait = time.monotonic() - started
+        self.waited[lane] += 1
+        self.wait_total[lane] += wait
+        self.wait_max[lane] = max(self.wait_max[lane], wait)
+
+    def wake(self):
+        for lane in LANES:
+            waiters = self.waiters[lane]
+            while waiters and self.available(lane):
+                future = waiters.popleft()
+                if not future.done():
+                    self.active[lane] += 1
+                    future.set_result(None)
+
+    async def acquire(self, lane):
+        started = time.monotonic()
+        if not self.waiters[lane] and self.available(lane):
+            self.active[lane] += 1
+            self.record_wait(lane, started)
+            return
+
+        if len(self.waiters[lane]) >= self.max_queue[lane]:
+            self.rejected[lane] += 1
+            raise UpstreamBusy(
+                f"Очередь запросов к Open-Meteo переполнена ({lane})")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(lane)
+            else:
+                self.waiters[lane].remove(future)
+            raise
+        self.record_wait(lane, started)
+
+    def release(self, lane):
+        self.active[lane] -= 1
+        self.wake()
+
+    async def run(self, func, lane=None):
+        lane = lane or upstream_lane.get()
+        await self.acquire(lane)
+        try:
+            return await func()
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        return {
+            lane: {
+                "active": self.active[lane],
+                "queued": len(self.waiters[lane]),
+                "rejected": self.rejected[lane],
+                "wait_avg": round(
+                    self.wait_total[lane] / self.waited[lane], 4)
+                if self.waited[lane] else None,
+                "wait_max": round(self.wait_max[lane], 4),
+            }
+            for lane in LANES
+        }
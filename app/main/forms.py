@@ -2,6 +2,7 @@ from django import forms
 from django.contrib.auth.models import User
 from django.utils import timezone
 from .models import UserCity, City
+from .cities import find_city, afind_city
 from django.core.exceptions import ValidationError
 
 
@@ -10,6 +11,12 @@ class RegistrationForm(forms.ModelForm):
         widget=forms.PasswordInput,
     )
 
+    taken_messages = {
+        'email': 'Пользователь с таким email уже существует.',
+        'username': 'Пользователь с таким именем уже существует.',
+    }
+    check_unique = True
+
     class Meta:
         model = User
         fields = ['username', 'email', 'password']
@@ -18,19 +25,31 @@ class RegistrationForm(forms.ModelForm):
         email = self.cleaned_data.get('email')
         if not email:
             raise ValidationError('Email обязателен.')
-        if User.objects.filter(email=email).exists():
-            raise ValidationError('Пользователь с таким email уже существует.')
+        if self.check_unique and User.objects.filter(email=email).exists():
+            raise ValidationError(self.taken_messages['email'])
         return email
 
     def clean_username(self):
         username = self.cleaned_data.get('username')
         if not username:
             raise ValidationError('username обязателен.')
-        if User.objects.filter(username=username).exists():
-            raise ValidationError(
-                'Пользователь с таким именем уже существует.')
+        if self.check_unique and User.objects.filter(username=username).exists():
+            raise ValidationError(self.taken_messages['username'])
         return username
 
+    def validate_unique(self):
+        if self.check_unique:
+            super().validate_unique()
+
+    async def ais_valid(self):
+        self.check_unique = False
+        self.is_valid()
+        for field, message in self.taken_messages.items():
+            value = self.cleaned_data.get(field)
+            if value and await User.objects.filter(**{field: value}).aexists():
+                self.add_error(field, message)
+        return not self.errors
+
     def clean_password(self):
         password = self.cleaned_data.get('password')
         if not password:
@@ -85,6 +104,41 @@ class AddCityForm(forms.ModelForm):
 
         return cleaned_data
 
+    def save(self, commit=True):
+        city = find_city(
+            self.cleaned_data['latitude'], self.cleaned_data['longitude'])
+        if city is not None:
+            return city
+        return super().save(commit)
+
+    async def asave(self):
+        city = await afind_city(
+            self.cleaned_data['latitude'], self.cleaned_data['longitude'])
+        if city is not None:
+            return city
+        city = super().save(commit=False)
+        await city.asave()
+        return city
+
+
+class UserCityField(forms.ModelMultipleChoiceField):
+    prefetched = None
+
+    def _check_values(self, value):
+        if self.prefetched is None:
+            return super()._check_values(value)
+
+        selected = []
+        for pk in value:
+            try:
+                selected.append(self.prefetched[int(pk)])
+            except (KeyError, TypeError, ValueError):
+                raise ValidationError(
+                    self.error_messages['invalid_choice'],
+                    code='invalid_choice',
+                    params={'value': pk})
+        return selected
+
 
 class DateRangeForm(forms.Form):
     start_date = forms.DateField(
@@ -95,9 +149,9 @@ class DateRangeForm(forms.Form):
         widget=forms.DateInput(attrs={'type': 'date'}),
         label='End Date'
     )
-    cities = forms.ModelChoiceField(
+    cities = UserCityField(
         queryset=UserCity.objects.none(),
-        label='Select City',
+        label='Select Cities',
         required=False
     )
     parameters = forms.MultipleChoiceField(
@@ -149,6 +203,33 @@ class DateRangeForm(forms.Form):
         required=False,
         widget=forms.CheckboxSelectMultiple()
     )
+    resolution = forms.ChoiceField(
+        choices=[
+            ("1", "Каждый час"),
+            ("6", "Каждые 6 часов"),
+            ("24", "По дням"),
+        ],
+        label='Resolution',
+        initial="1",
+        required=False
+    )
+    aggregations = forms.MultipleChoiceField(
+        choices=[
+            ("min", "Минимум"),
+            ("mean", "Среднее"),
+            ("max", "Максимум"),
+            ("sum", "Сумма"),
+        ],
+        label='Aggregations',
+        initial=["mean"],
+        required=False,
+        widget=forms.CheckboxSelectMultiple()
+    )
+    target_points = forms.IntegerField(
+        label='Max Points',
+        min_value=3,
+        required=False
+    )
 
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
@@ -159,6 +240,15 @@ class DateRangeForm(forms.Form):
                 user=user).select_related('city')
             self.fields['cities'].queryset = user_cities
 
+    async def aload_cities(self):
+        field = self.fields['cities']
+        field.prefetched = {
+            user_city.pk: user_city async for user_city in field.queryset}
+
+    async def ais_valid(self):
+        await self.aload_cities()
+        return self.is_valid()
+
     def clean(self):
         cleaned_data = super().clean()
         start_date = cleaned_data.get('start_date')
@@ -179,4 +269,41 @@ class DateRangeForm(forms.Form):
             if start_date > today or end_date > today:
                 raise ValidationError('Даты должны быть до текущего числа.')
 
+        if not cleaned_data.get('cities'):
+            self.add_error('cities', 'Выберите хотя бы один город.')
+
+        cleaned_data['resolution'] = int(cleaned_data.get('resolution') or 1)
+        if not cleaned_data.get('aggregations'):
+            cleaned_data['aggregations'] = ['mean']
+
+        return cleaned_data
+
+
+class CoordinateField(forms.FloatField):
+    def to_python(self, value):
+        if isinstance(value, str):
+            value = value.replace(',', '.')
+        return super().to_python(value)
+
+
+class CoordinatesForm(forms.Form):
+    latitude = CoordinateField(min_value=-90, max_value=90)
+    longitude = CoordinateField(min_value=-180, max_value=180)
+
+
+class HourlyQueryForm(CoordinatesForm):
+    start_date = forms.DateField()
+    end_date = forms.DateField()
+    parameters = forms.MultipleChoiceField(
+        choices=DateRangeForm.base_fields['parameters'].choices)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+
+        if start_date and end_date and end_date <= start_date:
+            raise ValidationError(
+                'Дата окончания должна быть позже даты начала.')
+
         return cleaned_data
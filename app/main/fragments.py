@@ -0,0 +1,36 @@
+from django.core.cache import cache
+from django.db.models import Count, Max
+from .config import INDEX_FRAGMENT_TTL
+from .models import UserCity
+
+def user_version_key(user_id):
+    return f"index-version:{user_id}"
+
+
+def bump_version(key):
+    version = cache.get(key, 0) + 1
+    cache.set(key, version, timeout=None)
+    return version
+
+
+def invalidate_user(user_id):
+    return bump_version(user_version_key(user_id))
+
+
+async def fragment_key(user_id):
+    version = await cache.aget(user_version_key(user_id), 0)
+    cities = await UserCity.objects.filter(user_id=user_id).aaggregate(
+        last=Max('id'), count=Count('id'),
+        fetched_at=Max('city__snapshot__fetched_at'))
+    fetched_at = cities['fetched_at']
+    fetched_at = 0 if fetched_at is None else fetched_at.timestamp()
+    return (f"index:{user_id}:{version}:{cities['last']}:{cities['count']}:"
+            f"{fetched_at}")
+
+
+async def get_fragment(key):
+    return await cache.aget(key)
+
+
+async def set_fragment(key, html):
+    await cache.aset(key, html, INDEX_FRAGMENT_TTL)
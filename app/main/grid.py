@@ -0,0 +1,24 @@
+from .config import GRID_STEP
+
+
+def snap(value, step=GRID_STEP):
+    if not step:
+        return value
+    return round(round(value / step) * step, 6)
+
+
+def snap_point(latitude, longitude, step=GRID_STEP):
+    return snap(latitude, step), snap(longitude, step)
+
+
+def cell_key(latitude, longitude, step=GRID_STEP):
+    latitude, longitude = snap_point(latitude, longitude, step)
+    return f"{latitude}:{longitude}"
+
+
+def neighbour_keys(latitude, longitude, step=GRID_STEP):
+    latitude, longitude = snap_point(latitude, longitude, step)
+    return [
+        cell_key(latitude + i * step, longitude + j * step, step)
+        for i in (-1, 0, 1) for j in (-1, 0, 1)
+    ]
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from django.utils import timezone
+from .batch import chunked
+from .config import (openmeteo, setup_logging, FORECAST_URL, ARCHIVE_URL,
+                     CACHE_EXPIRE, BATCH_SIZE, HISTORY_CACHE_SIZE,
+                     HISTORY_CACHE_TTL, HISTORY_VARIABLES, ARCHIVE_LAG_DAYS)
+from .grid import snap_point
+from .memcache import TTLCache
+from .store import HistoryStore
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+HOURS = 24
+
+
+def day_range(start_date, end_date):
+    return [start_date + timedelta(days=i)
+            for i in range((end_date - start_date).days + 1)]
+
+
+def archive_end():
+    return timezone.now().date() - timedelta(days=ARCHIVE_LAG_DAYS)
+
+
+class HourlyChunkCache:
+    def __init__(
+            self,
+            maxsize=HISTORY_CACHE_SIZE,
+            ttl=HISTORY_CACHE_TTL,
+            recent_ttl=CACHE_EXPIRE):
+        self.chunks = TTLCache(maxsize, ttl)
+        self.recent_ttl = recent_ttl
+
+    def get(self, cell, variable, day):
+        return self.chunks.get((cell, variable, day))
+
+    def put(self, cell, variable, day, values):
+        recent = day >= timezone.now().date() - timedelta(days=1)
+        self.chunks.set(
+            (cell, variable, day), values,
+            ttl=self.recent_ttl if recent else None)
+
+    def stats(self):
+        return self.chunks.stats()
+
+
+history_cache = HourlyChunkCache()
+history_store = HistoryStore()
+
+
+def parse_hourly(response, variables):
+    hourly = response.Hourly()
+    return {
+        variable: hourly.Variables(i).ValuesAsNumpy()
+        for i, variable in enumerate(variables)
+    }
+
+
+async def fetch_hourly(cells, start_date, end_date, variables, url=FORECAST_URL):
+    params = {
+        "latitude": ",".join(str(latitude) for latitude, _ in cells),
+        "longitude": ",".join(str(longitude) for _, longitude in cells),
+        "hourly": variables,
+        "start_date": start_date,
+        "end_date": end_date
+    }
+    responses = await openmeteo.weather_api(url, params=params)
+    return [parse_hourly(response, variables) for response in responses]
+
+
+def split_days(values, start_date, end_date):
+    for i, day in enumerate(day_range(start_date, end_date)):
+        chunk = values[i * HOURS:(i + 1) * HOURS].copy()
+        if len(chunk) == HOURS:
+            yield day, chunk
+
+
+async def fetch_missing(keys, url, cache, store):
+    cells = list(dict.fromkeys(cell for cell, _, _ in keys))
+    variables = list(dict.fromkeys(variable for _, variable, _ in keys))
+    first = min(day for _, _, day in keys)
+    last = max(day for _, _, day in keys)
+    logger.debug(f"Загрузка {variables} с {first} по {last} "
+                 f"для {len(cells)} ячеек")
+
+    found = {}
+    for chunk in chunked(cells, BATCH_SIZE):
+        responses = await fetch_hourly(chunk, first, last, variables, url=url)
+        for cell, series in zip(chunk, responses):
+            if store is not None and url == ARCHIVE_URL:
+                await asyncio.to_thread(write_series, store, cell, first, series)
+            for variable, values in series.items():
+                for day, values_chunk in split_days(values, first, last):
+                    cache.put(cell, variable, day, values_chunk)
+                    found[cell, variable, day] = values_chunk
+    return found
+
+
+def write_series(store, cell, start_date, series):
+    for variable, values in series.items():
+        store.write(cell, variable, start_date, values)
+
+
+def read_store(store, keys):
+    days = {}
+    for cell, variable, day in keys:
+        days.setdefault((cell, variable), []).append(day)
+
+    found = {}
+    for (cell, variable), variable_days in days.items():
+        for day, chunk in store.read(cell, variable, variable_days).items():
+            found[cell, variable, day] = chunk
+    return found
+
+
+async def load_cells(cells, days, variables, cache, store):
+    found = {}
+    missing = []
+    for cell in cells:
+        for variable in variables:
+            for day in days:
+                values = cache.get(cell, variable, day)
+                if values is None:
+                    missing.append((cell, variable, day))
+                else:
+                    found[cell, variable, day] = values
+
+    if missing and store is not None:
+        stored = await asyncio.to_thread(
+            read_store, store,
+            [key for key in missing if key[1] in HISTORY_VARIABLES])
+        for (cell, variable, day), chunk in stored.items():
+            cache.put(cell, variable, day, chunk)
+        found.update(stored)
+        missing = [key for key in missing if key not in stored]
+
+    if missing:
+        last_archived = archive_end()
+        archived = [
+            (cell, variable, day) for cell, variable, day in missing
+            if store is not None and variable in HISTORY_VARIABLES
+            and day <= last_archived]
+        recent = [key for key in missing if key not in archived]
+
+        for keys, url in ((archived, ARCHIVE_URL), (recent, FORECAST_URL)):
+            if keys:
+                fetched = await fetch_missing(keys, url, cache, store)
+                for key in keys:
+                    found[key] = fetched[key]
+
+    return found
+
+
+def hour_range(start_date, days):
+    return pd.date_range(
+        start=pd.Timestamp(start_date, tz="UTC"),
+        periods=len(days) * HOURS,
+        freq="h",
+        name="date"
+    )
+
+
+async def load_hourly(
+        latitude,
+        longitude,
+        start_date,
+        end_date,
+        variables,
+        cache=history_cache,
+        store=history_store):
+    cell = snap_point(latitude, longitude)
+    days = day_range(start_date, end_date)
+    found = await load_cells([cell], days, variables, cache, store)
+
+    data = {"date": hour_range(start_date, days)}
+    for variable in variables:
+        data[variable] = np.concatenate(
+            [found[cell, variable, day] for day in days])
+
+    return pd.DataFrame(data=data)
+
+
+async def load_aligned(
+        cities,
+        start_date,
+        end_date,
+        variables,
+        cache=history_cache,
+        store=history_store,
+        names=None):
+    days = day_range(start_date, end_date)
+    columns = pd.MultiIndex.from_product(
+        [unique_labels(names or [city.name for city in cities]), variables],
+        names=["city", "variable"])
+    if not variables:
+        return pd.DataFrame(index=hour_range(start_date, days), columns=columns)
+
+    city_cells = [snap_point(city.latitude, city.longitude) for city in cities]
+    cells = list(dict.fromkeys(city_cells))
+    found = await load_cells(cells, days, variables, cache, store)
+
+    cube = np.stack([
+        found[cell, variable, day]
+        for cell in cells for variable in variables for day in days
+    ], dtype=np.float32).reshape(len(cells), len(variables), len(days) * HOURS)
+
+    positions = {cell: i for i, cell in enumerate(cells)}
+    index = np.array([positions[cell] for cell in city_cells], dtype=int)
+    values = cube[index].reshape(len(cities) * len(variables), -1).T
+
+    return pd.DataFrame(values, index=hour_range(start_date, days), columns=columns)
+
+
+def unique_labels(labels):
+    seen = set(labels)
+    counts = {}
+    result = []
+    for label in labels:
+        counts[label] = counts.get(label, 0) + 1
+        if counts[label] > 1:
+            suffix = counts[label]
+            while f"{label} ({suffix})" in seen:
+                suffix += 1
+            label = f"{label} ({suffix})"
+            seen.add(label)
+        result.append(label)
+    return result
+
+
+def comparison_table(aligned):
+    table = aligned.copy(deep=False)
+    variables = table.columns.get_level_values("variable")
+    if len(table.columns) == variables.nunique():
+        table.columns = list(table.columns.get_level_values("variable"))
+    else:
+        table.columns = [f"{city}: {variable}" for city, variable in table.columns]
+    return table.reset_index()
+
+
+async def store_history(
+        cities,
+        start_date,
+        end_date,
+        url=ARCHIVE_URL,
+        variables=HISTORY_VARIABLES,
+        store=history_store):
+    cells = list(dict.fromkeys(
+        snap_point(city.latitude, city.longitude) for city in cities))
+    stored = 0
+
+    for chunk in chunked(cells, BATCH_SIZE):
+        params = {
+            "latitude": ",".join(str(latitude) for latitude, _ in chunk),
+            "longitude": ",".join(str(longitude) for _, longitude in chunk),
+            "hourly": variables,
+            "start_date": start_date,
+            "end_date": end_date
+        }
+        try:
+            responses = await openmeteo.weather_api(url, params=params)
+        except Exception as e:
+            logger.error(
+                f"Ошибка при загрузке истории для {len(chunk)} ячеек: {e}")
+            continue
+
+        for cell, response in zip(chunk, responses):
+            await asyncio.to_thread(
+                write_series, store, cell, start_date,
+                parse_hourly(response, variables))
+            stored += 1
+
+    logger.info(
+        f"История с {start_date} по {end_date} сохранена для {stored} ячеек")
+    return stored
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import os
+from .config import setup_logging, LEADER_LOCK_PATH, LEADER_RETRY_INTERVAL
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class FileLeaderLock:
+    def __init__(self, path=LEADER_LOCK_PATH):
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            logger.warning("fcntl недоступен, выбор лидера отключён")
+            self._file = open(os.devnull, 'w')
+            return True
+
+        file = open(self.path, 'a+')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+async def run_as_leader(func, lock=None, retry_interval=LEADER_RETRY_INTERVAL):
+    lock = lock or FileLeaderLock()
+    while not lock.try_acquire():
+        await asyncio.sleep(retry_interval)
+
+    logger.info(f"Процесс {os.getpid()} стал лидером")
+    try:
+        return await func()
+    finally:
+        lock.release()
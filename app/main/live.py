@@ -0,0 +1,29 @@
+import logging
+from channels.layers import get_channel_layer
+from .config import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+def city_group(city_id):
+    return f"city-{city_id}"
+
+
+async def publish_changes(snapshots):
+    layer = get_channel_layer()
+    if layer is None:
+        return 0
+
+    published = 0
+    for snapshot in snapshots:
+        await layer.group_send(city_group(snapshot.city_id), {
+            "type": "weather.update",
+            "city": snapshot.city_id,
+            "weather": snapshot.as_weather(),
+            "fetched_at": snapshot.fetched_at.isoformat(),
+        })
+        published += 1
+
+    logger.debug(f"Отправлено обновлений погоды: {published}")
+    return published
@@ -0,0 +1,43 @@
+import asyncio
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from main.config import openmeteo
+from main.history import store_history, archive_end
+from main.models import City
+
+
+class Command(BaseCommand):
+    help = 'Загружает почасовую историю погоды из архива Open-Meteo в локальное хранилище'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=92)
+        parser.add_argument('--start', type=str)
+        parser.add_argument('--end', type=str)
+
+    def parse_date(self, value, option):
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise CommandError(
+                f'Некорректная дата в {option}: {value}. Ожидается формат ГГГГ-ММ-ДД.')
+
+    def handle(self, *args, **options):
+        end_date = archive_end()
+        if options['end']:
+            end_date = self.parse_date(options['end'], '--end')
+        start_date = end_date - timedelta(days=options['days'] - 1)
+        if options['start']:
+            start_date = self.parse_date(options['start'], '--start')
+        if end_date < start_date:
+            raise CommandError('Дата окончания должна быть не раньше даты начала.')
+
+        cities = list(City.objects.only('id', 'latitude', 'longitude'))
+        stored = asyncio.run(self.store(cities, start_date, end_date))
+        self.stdout.write(
+            f"История с {start_date} по {end_date} сохранена для {stored} ячеек")
+
+    async def store(self, cities, start_date, end_date):
+        try:
+            return await store_history(cities, start_date, end_date)
+        finally:
+            await openmeteo.close()
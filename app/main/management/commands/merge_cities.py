@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.cities import merge_duplicates
+from main.config import CITY_TOLERANCE
+
+
+class Command(BaseCommand):
+    help = 'Объединяет города с совпадающими координатами и переносит на них города пользователей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tolerance', type=float, default=CITY_TOLERANCE)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['tolerance'] <= 0:
+            raise CommandError('Допуск должен быть больше нуля.')
+
+        duplicates = merge_duplicates(options['tolerance'], options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f"Найдено дубликатов городов: {len(duplicates)}")
+        else:
+            self.stdout.write(f"Объединено дубликатов городов: {len(duplicates)}")
@@ -1,12 +1,25 @@
 from django.db import models
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from .config import CITY_TOLERANCE
+from .grid import cell_key
 
 
 class City(models.Model):
     name = models.CharField(max_length=100, null=True, blank=True)
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
+    location_key = models.CharField(
+        max_length=32, blank=True, default='', editable=False, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['latitude', 'longitude'])]
+
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.location_key = cell_key(
+                self.latitude, self.longitude, CITY_TOLERANCE)
+        super().save(*args, **kwargs)
 
     def clean(self):
         if not self.name:
@@ -32,9 +45,33 @@ class City(models.Model):
 class UserCity(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     city = models.ForeignKey(City, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100, blank=True, default='')
 
     class Meta:
         unique_together = ('user', 'city')
 
+    @property
+    def label(self):
+        return self.name or self.city.name
+
+    def __str__(self):
+        return f"{self.label}"
+
+
+class WeatherSnapshot(models.Model):
+    city = models.OneToOneField(
+        City, on_delete=models.CASCADE, related_name='snapshot')
+    temperature = models.FloatField(null=True, blank=True)
+    wind_speed = models.FloatField(null=True, blank=True)
+    pressure = models.FloatField(null=True, blank=True)
+    fetched_at = models.DateTimeField()
+
+    def as_weather(self):
+        return {
+            "temperature": self.temperature,
+            "wind_speed": self.wind_speed,
+            "pressure": self.pressure,
+        }
+
     def __str__(self):
-        return f"{self.city.name}"
+        return f"{self.city.name} ({self.fetched_at})"
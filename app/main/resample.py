@@ -0,0 +1,86 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+AGGREGATIONS = {
+    "min": np.nanmin,
+    "mean": np.nanmean,
+    "max": np.nanmax,
+    "sum": np.nansum,
+}
+
+
+def resample(frame, hours, aggregations):
+    if hours <= 1:
+        return frame
+
+    buckets = -(-len(frame) // hours)
+    padding = buckets * hours - len(frame)
+    data = {"date": frame["date"].iloc[::hours].reset_index(drop=True)}
+
+    for column in frame.columns[1:]:
+        values = frame[column].to_numpy(dtype=np.float64)
+        values = np.concatenate([values, np.full(padding, np.nan)])
+        values = values.reshape(buckets, hours)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for how in aggregations:
+                data[f"{column}_{how}"] = AGGREGATIONS[how](values, axis=1)
+
+    return pd.DataFrame(data=data)
+
+
+def normalize(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low = np.nanmin(values, axis=0)
+        span = np.nanmax(values, axis=0) - low
+    span[~(span > 0)] = 1
+    return np.nan_to_num((values - low) / span)
+
+
+def lttb_indices(values, threshold):
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=np.float64)
+    every = (n - 2) / (threshold - 2)
+    edges = np.append(
+        np.floor(np.arange(threshold - 1) * every).astype(int) + 1, n)
+    edges[threshold - 2] = n - 1
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2]
+        avg_x = x[next_start:next_end].mean()
+        avg_y = values[next_start:next_end].mean(axis=0)
+
+        a = selected[i]
+        area = np.abs(
+            (x[a] - avg_x) * (values[start:end] - values[a])
+            - (x[a] - x[start:end])[:, None] * (avg_y - values[a])
+        ).sum(axis=1)
+        selected[i + 1] = start + int(np.argmax(area))
+
+    return selected
+
+
+def downsample(frame, target_points):
+    if not target_points or len(frame) <= target_points:
+        return frame
+
+    values = frame.iloc[:, 1:].to_numpy(dtype=np.float64)
+    if values.shape[1]:
+        indices = lttb_indices(normalize(values), target_points)
+    else:
+        indices = np.linspace(0, len(frame) - 1, target_points).astype(int)
+    return frame.iloc[indices].reset_index(drop=True)
+
+
+def reduce_frame(frame, hours=1, aggregations=("mean",), target_points=None):
+    return downsample(resample(frame, hours, aggregations), target_points)
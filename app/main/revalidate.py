@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from .config import setup_logging
+from .executor import use_lane, BACKGROUND
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class Revalidator:
+    def __init__(self):
+        self.pending = {}
+        self.tasks = set()
+
+    def schedule(self, items, key, func, lane=BACKGROUND):
+        items = [item for item in items if key(item) not in self.pending]
+        if not items:
+            return None
+        keys = {key(item) for item in items}
+
+        async def run():
+            try:
+                with use_lane(lane):
+                    return await func(items)
+            except Exception as e:
+                logger.warning(f"Ошибка фонового обновления данных: {e}")
+                return None
+            finally:
+                for item_key in keys:
+                    self.pending.pop(item_key, None)
+
+        task = asyncio.ensure_future(run())
+        for item_key in keys:
+            self.pending[item_key] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def wait(self):
+        await asyncio.gather(*self.tasks)
+
+
+revalidator = Revalidator()
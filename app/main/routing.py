@@ -0,0 +1,6 @@
+from django.urls import path
+from main import consumers
+
+websocket_urlpatterns = [
+    path('ws/weather/', consumers.WeatherConsumer.as_asgi()),
+]
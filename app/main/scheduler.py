@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+import zlib
+from django.utils import timezone
+from .config import setup_logging, REFRESH_INTERVAL, REFRESH_SLOTS
+from .grid import snap_point
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    def __init__(
+            self,
+            load,
+            refresh,
+            interval=REFRESH_INTERVAL,
+            slots=REFRESH_SLOTS):
+        self.load = load
+        self.refresh = refresh
+        self.interval = interval
+        self.slots = slots
+        self.last_cycle = None
+
+    def slot(self, city):
+        latitude, longitude = snap_point(city.latitude, city.longitude)
+        return zlib.crc32(f"{latitude},{longitude}".encode()) % self.slots
+
+    async def run_cycle(self):
+        started_at = timezone.now()
+        started = time.monotonic()
+        cities = await self.load()
+
+        buckets = {}
+        for city in cities:
+            buckets.setdefault(self.slot(city), []).append(city)
+
+        slot_length = self.interval / self.slots
+        refreshed = 0
+        missed = 0
+        late_slots = 0
+        busy = 0.0
+
+        for slot in range(self.slots):
+            slot_end = started + (slot + 1) * slot_length
+            due = buckets.get(slot)
+
+            if due:
+                slot_started = time.monotonic()
+                try:
+                    count = await self.refresh(due)
+                except Exception as e:
+                    logger.error(f"Ошибка при обновлении слота {slot}: {e}")
+                    count = 0
+                busy += time.monotonic() - slot_started
+
+                if time.monotonic() > slot_end:
+                    logger.warning(
+                        f"Слот {slot} не уложился в отведённое время")
+                    late_slots += 1
+                missed += len(due) - count
+                refreshed += count
+
+            await asyncio.sleep(max(0, slot_end - time.monotonic()))
+
+        self.last_cycle = {
+            "started_at": started_at.isoformat(),
+            "duration": round(time.monotonic() - started, 3),
+            "busy": round(busy, 3),
+            "cities": len(cities),
+            "refreshed": refreshed,
+            "missed": missed,
+            "late_slots": late_slots,
+        }
+        logger.info(f"Цикл обновления завершён: {self.last_cycle}")
+        return self.last_cycle
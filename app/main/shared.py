@@ -0,0 +1,162 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+from .memcache import hit_ratio
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FIELDS = ("temperature", "wind_speed", "pressure")
+READ_RETRIES = 8
+
+SLOT = np.dtype([
+    ("seq", "<u8"),
+    ("latitude", "<i4"),
+    ("longitude", "<i4"),
+    ("updated_at", "<f8"),
+    ("stored_at", "<f8"),
+    ("values", "<f4", (len(FIELDS),)),
+])
+
+
+def cell_of(latitude, longitude, step):
+    return round(latitude / step), round(longitude / step)
+
+
+class SharedForecastCache:
+    def __init__(self, path, slots, step, probes=8):
+        self.path = path
+        self.slots = slots
+        self.step = step
+        self.probes = min(probes, slots)
+        self._file = None
+        self._table = None
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+
+    @property
+    def table(self):
+        if self._table is None:
+            self.open()
+        return self._table
+
+    def open(self):
+        size = self.slots * SLOT.itemsize
+        exists = os.path.exists(self.path)
+        if not exists or os.path.getsize(self.path) != size:
+            self.create(size, replace=exists)
+        self._file = open(self.path, 'r+b')
+        self._table = np.memmap(
+            self._file, dtype=SLOT, mode='r+', shape=(self.slots,))
+
+    def create(self, size, replace):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.truncate(size)
+            if replace:
+                os.replace(tmp_path, self.path)
+            else:
+                os.link(tmp_path, self.path)
+        except FileExistsError:
+            pass
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @contextmanager
+    def locked(self):
+        table = self.table
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield table
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def positions(self, cell):
+        start = ((cell[0] * 73856093) ^ (cell[1] * 19349663)) % self.slots
+        return [(start + i) % self.slots for i in range(self.probes)]
+
+    def read(self, index):
+        table = self.table
+        for _ in range(READ_RETRIES):
+            before = int(table["seq"][index])
+            if before % 2 == 0:
+                record = np.array(table[index:index + 1])[0]
+                if int(table["seq"][index]) == before:
+                    return record
+            self.retries += 1
+        return None
+
+    def get(self, latitude, longitude, max_age=None, now=None):
+        cell = cell_of(latitude, longitude, self.step)
+        now = time.time() if now is None else now
+        for index in self.positions(cell):
+            record = self.read(index)
+            if (record is None or not record["stored_at"]
+                    or (record["latitude"], record["longitude"]) != cell):
+                continue
+            age = now - record["stored_at"]
+            if max_age is not None and age >= max_age:
+                break
+            self.hits += 1
+            weather = {
+                field: None if np.isnan(value) else float(value)
+                for field, value in zip(FIELDS, record["values"])
+            }
+            updated_at = datetime.fromtimestamp(
+                record["updated_at"], tz=timezone.utc)
+            return (weather, updated_at), age
+
+        self.misses += 1
+        return None
+
+    def slot_for(self, table, cell):
+        positions = self.positions(cell)
+        for index in positions:
+            if (table["stored_at"][index]
+                    and (table["latitude"][index], table["longitude"][index]) == cell):
+                return index
+        return min(positions, key=lambda index: table["stored_at"][index])
+
+    def set_many(self, entries, now=None):
+        now = time.time() if now is None else now
+        with self.locked() as table:
+            for latitude, longitude, weather, updated_at in entries:
+                cell = cell_of(latitude, longitude, self.step)
+                index = self.slot_for(table, cell)
+                seq = int(table["seq"][index]) | 1
+                table["seq"][index] = seq
+                table["latitude"][index], table["longitude"][index] = cell
+                table["updated_at"][index] = updated_at.timestamp()
+                table["stored_at"][index] = now
+                table["values"][index] = [
+                    np.nan if weather.get(field) is None else weather[field]
+                    for field in FIELDS]
+                table["seq"][index] = seq + 1
+
+    def set(self, latitude, longitude, weather, updated_at, now=None):
+        self.set_many([(latitude, longitude, weather, updated_at)], now)
+
+    def clear(self):
+        with self.locked() as table:
+            table["stored_at"][:] = 0
+
+    def stats(self):
+        return {
+            "size": int(np.count_nonzero(self.table["stored_at"])),
+            "slots": self.slots,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": hit_ratio(self.hits, self.misses),
+            "retries": self.retries,
+        }
@@ -0,0 +1,10 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .fragments import invalidate_user
+from .models import UserCity
+
+
+@receiver(post_save, sender=UserCity)
+@receiver(post_delete, sender=UserCity)
+def invalidate_index(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from datetime import timedelta
+from django.utils import timezone
+from .batch import fetch_weather_batch
+from .config import setup_logging, SNAPSHOT_MAX_AGE, STALE_MAX_AGE, BATCH_CONCURRENCY
+from .live import publish_changes
+from .models import WeatherSnapshot
+from .executor import INTERACTIVE
+from .revalidate import revalidator
+from .spatial import snapshot_index
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FIELDS = ['temperature', 'wind_speed', 'pressure', 'fetched_at']
+
+
+def get_snapshot(city):
+    return getattr(city, 'snapshot', None)
+
+
+def is_fresh(snapshot, now=None):
+    now = now or timezone.now()
+    return snapshot.fetched_at >= now - timedelta(seconds=SNAPSHOT_MAX_AGE)
+
+
+def to_float(value):
+    return None if value is None else round(float(value), 2)
+
+
+async def load_previous(cities):
+    return {
+        snapshot.city_id: snapshot.as_weather()
+        async for snapshot in WeatherSnapshot.objects.filter(
+            city__in=[city.id for city in cities])
+    }
+
+
+async def asave_snapshots(cities, weather, fetched_at=None):
+    fetched_at = fetched_at or timezone.now()
+    snapshots = [
+        WeatherSnapshot(
+            city=city,
+            fetched_at=fetched_at,
+            **{key: to_float(value) for key, value in weather[city.id].items()})
+        for city in cities if weather.get(city.id) is not None
+    ]
+    await WeatherSnapshot.objects.abulk_create(
+        snapshots,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['city'],
+        update_fields=SNAPSHOT_FIELDS,
+    )
+    logger.debug(f"Сохранено снимков погоды: {len(snapshots)}")
+    return snapshots
+
+
+def changed_snapshots(snapshots, previous):
+    return [
+        snapshot for snapshot in snapshots
+        if previous.get(snapshot.city_id) != snapshot.as_weather()]
+
+
+def snapshot_age(snapshot, now=None):
+    now = now or timezone.now()
+    return int((now - snapshot.fetched_at).total_seconds())
+
+
+def stale_weather(snapshot, now=None):
+    return dict(snapshot.as_weather(), age=snapshot_age(snapshot, now))
+
+
+async def refresh_cities(cities, concurrency=BATCH_CONCURRENCY):
+    fetched = await fetch_weather_batch(cities, concurrency=concurrency)
+    previous = await load_previous(cities)
+    snapshots = await asave_snapshots(cities, fetched)
+    snapshot_index.update(snapshots)
+    changed = changed_snapshots(snapshots, previous)
+    if changed:
+        await publish_changes(changed)
+    return snapshots
+
+
+def city_key(city):
+    return ("city", city.id)
+
+
+async def latest_weather(cities):
+    weather, _ = await latest_weather_partial(cities)
+    return weather
+
+
+async def latest_weather_partial(cities, timeout=None):
+    now = timezone.now()
+    weather = {}
+    stale = []
+    missing = []
+
+    for city in cities:
+        snapshot = get_snapshot(city)
+        if snapshot is not None and is_fresh(snapshot, now):
+            weather[city.id] = snapshot.as_weather()
+        elif snapshot is not None and snapshot_age(snapshot, now) < STALE_MAX_AGE:
+            weather[city.id] = stale_weather(snapshot, now)
+            stale.append(city)
+        else:
+            missing.append(city)
+
+    tasks = {}
+    if missing:
+        logger.debug(f"Нет свежих снимков для {len(missing)} городов")
+        revalidator.schedule(missing, city_key, refresh_cities, lane=INTERACTIVE)
+        tasks = {
+            city.id: revalidator.pending.get(city_key(city)) for city in missing}
+
+    if stale:
+        logger.debug(f"Фоновое обновление устаревших снимков для {len(stale)} городов")
+        revalidator.schedule(stale, city_key, refresh_cities)
+
+    pending = set()
+    if missing:
+        running = {task for task in tasks.values() if task is not None}
+        if running:
+            await asyncio.wait(running, timeout=timeout)
+        for task in running:
+            for snapshot in (task.result() if task.done() else None) or []:
+                if snapshot.city_id in tasks:
+                    weather[snapshot.city_id] = snapshot.as_weather()
+
+        for city in missing:
+            if city.id in weather:
+                continue
+            task = tasks[city.id]
+            if task is not None and not task.done():
+                pending.add(city.id)
+            snapshot = get_snapshot(city)
+            weather[city.id] = (
+                None if snapshot is None else stale_weather(snapshot, now))
+
+    return weather, pending
@@ -0,0 +1,137 @@
+import logging
+import math
+import time
+from datetime import timedelta
+from django.utils import timezone
+from .config import (setup_logging, SNAPSHOT_MAX_AGE, SPATIAL_BUCKET,
+                     NEAREST_MAX_DISTANCE, SPATIAL_SYNC_INTERVAL)
+from .grid import snap_point
+from .models import WeatherSnapshot
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(longitude2 - longitude1)
+    a = (math.sin(dphi / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SnapshotIndex:
+    def __init__(
+            self,
+            step=SPATIAL_BUCKET,
+            max_distance=NEAREST_MAX_DISTANCE,
+            sync_interval=SPATIAL_SYNC_INTERVAL):
+        self.step = step
+        self.max_distance = max_distance
+        self.sync_interval = sync_interval
+        self.buckets = {}
+        self.cells = {}
+        self.synced_at = None
+        self.checked_at = None
+
+    def __len__(self):
+        return len(self.cells)
+
+    def bucket(self, latitude, longitude):
+        return snap_point(latitude, longitude, self.step)
+
+    def remove(self, city_id):
+        key = self.cells.pop(city_id, None)
+        if key is None:
+            return
+        bucket = self.buckets[key]
+        bucket.pop(city_id, None)
+        if not bucket:
+            del self.buckets[key]
+
+    def add(self, city_id, latitude, longitude, weather, fetched_at):
+        key = self.bucket(latitude, longitude)
+        if self.cells.get(city_id) != key:
+            self.remove(city_id)
+        self.cells[city_id] = key
+        self.buckets.setdefault(key, {})[city_id] = (
+            latitude, longitude, weather, fetched_at)
+
+    def update(self, snapshots):
+        for snapshot in snapshots:
+            city = snapshot.city
+            if city.latitude is None or city.longitude is None:
+                continue
+            self.add(snapshot.city_id, city.latitude, city.longitude,
+                     snapshot.as_weather(), snapshot.fetched_at)
+
+    def prune(self, oldest):
+        expired = [
+            city_id
+            for bucket in self.buckets.values()
+            for city_id, entry in bucket.items() if entry[3] < oldest]
+        for city_id in expired:
+            self.remove(city_id)
+        return len(expired)
+
+    def nearest(self, latitude, longitude, max_distance=None, now=None):
+        max_distance = self.max_distance if max_distance is None else max_distance
+        oldest = (now or timezone.now()) - timedelta(seconds=SNAPSHOT_MAX_AGE)
+
+        latitude_steps = math.ceil(max_distance / (KM_PER_DEGREE * self.step))
+        scale = max(math.cos(math.radians(latitude)), 0.01)
+        longitude_steps = min(
+            math.ceil(latitude_steps / scale), math.ceil(180 / self.step))
+        base_latitude, base_longitude = self.bucket(latitude, longitude)
+
+        best = None
+        for i in range(-latitude_steps, latitude_steps + 1):
+            for j in range(-longitude_steps, longitude_steps + 1):
+                key = self.bucket(
+                    base_latitude + i * self.step, base_longitude + j * self.step)
+                for city_id, entry in self.buckets.get(key, {}).items():
+                    city_latitude, city_longitude, weather, fetched_at = entry
+                    if fetched_at < oldest:
+                        continue
+                    distance = haversine(
+                        latitude, longitude, city_latitude, city_longitude)
+                    if distance <= max_distance and (
+                            best is None or distance < best["distance"]):
+                        best = {
+                            "city_id": city_id,
+                            "weather": weather,
+                            "fetched_at": fetched_at,
+                            "distance": distance,
+                        }
+        return best
+
+    async def load(self, since):
+        return [snapshot async for snapshot in WeatherSnapshot.objects.select_related(
+            'city').filter(fetched_at__gt=since).order_by('fetched_at')]
+
+    async def sync(self, force=False):
+        now = time.monotonic()
+        if (not force and self.checked_at is not None
+                and now - self.checked_at < self.sync_interval):
+            return 0
+        self.checked_at = now
+
+        oldest = timezone.now() - timedelta(seconds=SNAPSHOT_MAX_AGE)
+        since = oldest if self.synced_at is None else max(oldest, self.synced_at)
+        snapshots = await self.load(since)
+        self.update(snapshots)
+        if snapshots:
+            self.synced_at = snapshots[-1].fetched_at
+        pruned = self.prune(oldest)
+
+        logger.debug(
+            f"Пространственный индекс: добавлено {len(snapshots)}, "
+            f"удалено {pruned}, всего {len(self)}")
+        return len(snapshots)
+
+
+snapshot_index = SnapshotIndex()
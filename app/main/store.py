@@ -0,0 +1,80 @@
+import calendar
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import groupby
+import numpy as np
+from .config import HISTORY_DIR
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HOURS = 24
+
+
+def month_of(day):
+    return day.replace(day=1)
+
+
+class HistoryStore:
+    def __init__(self, root=HISTORY_DIR):
+        self.root = root
+
+    def path(self, cell, variable, month):
+        latitude, longitude = cell
+        return os.path.join(
+            self.root, f"{latitude}_{longitude}", month.strftime("%Y-%m"),
+            f"{variable}.npy")
+
+    @contextmanager
+    def locked(self, path):
+        with open(f"{path}.lock", 'a') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def read(self, cell, variable, days):
+        found = {}
+        for month, month_days in groupby(sorted(days), key=month_of):
+            path = self.path(cell, variable, month)
+            if not os.path.exists(path):
+                continue
+            values = np.load(path, mmap_mode='r')
+            for day in month_days:
+                chunk = values[(day.day - 1) * HOURS:day.day * HOURS]
+                if not np.isnan(chunk).all():
+                    found[day] = np.array(chunk)
+        return found
+
+    def write(self, cell, variable, start_date, values):
+        days = [start_date + timedelta(days=i)
+                for i in range(len(values) // HOURS)]
+
+        for month, month_days in groupby(days, key=month_of):
+            path = self.path(cell, variable, month)
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+
+            with self.locked(path):
+                if os.path.exists(path):
+                    data = np.load(path)
+                else:
+                    length = calendar.monthrange(month.year, month.month)[1]
+                    data = np.full(length * HOURS, np.nan, dtype=np.float32)
+
+                for day in month_days:
+                    offset = (day - start_date).days * HOURS
+                    data[(day.day - 1) * HOURS:day.day * HOURS] = \
+                        values[offset:offset + HOURS]
+
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as file:
+                    np.save(file, data)
+                os.replace(tmp_path, path)
@@ -0,0 +1,56 @@
+import zlib
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from .config import STREAM_CHUNK_ROWS
+
+ROWS_MARKER = "<!--rows-->"
+
+
+def format_column(values):
+    if np.issubdtype(values.dtype, np.datetime64):
+        text = np.datetime_as_string(values, unit='s')
+        return np.char.add(np.char.replace(text, 'T', ' '), '+00:00')
+    return values.astype(str)
+
+
+def table_rows(frame, chunk_size=STREAM_CHUNK_ROWS):
+    columns = [frame[name].to_numpy() for name in frame.columns]
+    for start in range(0, len(frame), chunk_size):
+        rows = np.full(min(chunk_size, len(frame) - start), '<tr>')
+        for values in columns:
+            cells = format_column(values[start:start + chunk_size])
+            rows = np.char.add(rows, np.char.add(np.char.add('<td>', cells), '</td>'))
+        yield "".join(np.char.add(rows, '</tr>\n'))
+
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def stream_table(request, template_name, context, frame):
+    context = {**context, 'columns': list(frame.columns)}
+    html = await sync_to_async(render_to_string)(template_name, context, request)
+    head, tail = html.split(ROWS_MARKER, 1)
+
+    async def content():
+        yield head
+        for rows in table_rows(frame):
+            yield rows
+        yield tail
+
+    accepts_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    response = StreamingHttpResponse(
+        gzip_stream(content()) if accepts_gzip else content(),
+        content_type='text/html; charset=utf-8')
+    if accepts_gzip:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
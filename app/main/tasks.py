@@ -1,39 +1,53 @@
-import asyncio
 import logging
-from asgiref.sync import sync_to_async
+from datetime import timedelta
+from django.utils import timezone
 from .models import City
 
 import logging
-from .config import openmeteo, setup_logging
+from .config import setup_logging, forecast_cache, REFRESH_WORKERS, FORECAST_URL
+from .history import store_history
+from .scheduler import RefreshScheduler
+from .executor import upstream_lane, BACKGROUND
+from .snapshots import refresh_cities
 
 setup_logging()
 logger = logging.getLogger(__name__)
 
 
+async def get_cities():
+    return [city async for city in City.objects.filter(
+        usercity__isnull=False).distinct().only('id', 'latitude', 'longitude')]
+
+
 async def periodic_update():
     logger.info("Запуск periodic_update")
+    upstream_lane.set(BACKGROUND)
+    appended = None
     while True:
-        await update_cache_async()
-        await asyncio.sleep(15 * 60)
+        await scheduler.run_cycle()
+
+        yesterday = timezone.now().date() - timedelta(days=1)
+        if appended != yesterday:
+            await store_history(
+                await get_cities(), yesterday, yesterday, url=FORECAST_URL)
+            appended = yesterday
 
 
-async def update_cache_async():
+async def update_cache_async(cities=None):
     logger.info("Начало обновления кеша")
-    @sync_to_async
-    def get_cities():
-        return list(City.objects.all())
-    cities = await get_cities()
-
-    url = "https://api.open-meteo.com/v1/forecast"
-
-    for city in cities:
-        params = {
-            "latitude": city.latitude,
-            "longitude": city.longitude,
-            "hourly": "temperature_2m,wind_speed_10m,pressure_msl"
-        }
-        responses = await asyncio.to_thread(openmeteo.weather_api, url, params=params)
-        logger.debug(
-            f"Данные получены для координат: {city.latitude}, {city.longitude}")
+    if cities is None:
+        cities = await get_cities()
+
+    snapshots = await refresh_cities(cities, concurrency=REFRESH_WORKERS)
+    forecast_cache.set_many(
+        (snapshot.city.latitude, snapshot.city.longitude,
+         snapshot.as_weather(), snapshot.fetched_at)
+        for snapshot in snapshots)
+    logger.debug(
+        f"Данные получены для {len(snapshots)} из {len(cities)} городов")
 
     logger.info("Обновление кеша завершено")
+    return len(snapshots)
+
+
+scheduler = RefreshScheduler(get_cities, update_cache_async)
@@ -1,8 +1,89 @@
 from .forms import RegistrationForm, LoginForm, AddCityForm, DateRangeForm
-from django.contrib.auth.models import User
-from django.test import TestCase
-from .models import UserCity, City
+from django.contrib.auth.models import User, AnonymousUser
+from django.test import TestCase, override_settings
+from .models import UserCity, City, WeatherSnapshot
 from django.utils import timezone
+from unittest import mock
+from .batch import fetch_weather_batch, parse_latest, nearest_index
+from .client import AsyncClient, encode_params
+from openmeteo_requests.Client import OpenMeteoRequestsError
+from .coalesce import SingleFlight
+from .grid import snap, snap_point
+from .snapshots import (asave_snapshots, latest_weather, latest_weather_partial,
+                        changed_snapshots, refresh_cities)
+from .spatial import SnapshotIndex, haversine
+from .revalidate import revalidator
+from .breaker import CircuitBreaker, CircuitOpen
+from .executor import (UpstreamExecutor, UpstreamBusy, use_lane, upstream_lane,
+                       INTERACTIVE, BACKGROUND)
+from .scheduler import RefreshScheduler
+from .leader import FileLeaderLock, run_as_leader
+from .memcache import TTLCache
+from .shared import SharedForecastCache, cell_of
+from . import views
+from .history import (HourlyChunkCache, load_hourly, load_aligned,
+                      comparison_table)
+from .store import HistoryStore
+from .streaming import table_rows, gzip_stream
+from .resample import resample, lttb_indices, reduce_frame
+from .consumers import WeatherConsumer
+from .bulk import parse_points, bulk_lines
+from .fragments import fragment_key
+from .cities import find_city, group_duplicates, merge_duplicates
+from .tasks import get_cities
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from .live import publish_changes
+from asgiref.testing import ApplicationCommunicator
+import json
+import pandas as pd
+import zlib
+import aiohttp
+import time
+from datetime import date, datetime
+from datetime import timezone as dt_timezone
+import tempfile
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+import asyncio
+from asgiref.sync import sync_to_async
+import requests_cache
+import numpy as np
+
+
+def make_response(temperature, wind_speed=1.0, pressure=1000.0):
+    values = [temperature, wind_speed, pressure]
+    current = mock.Mock(Time=mock.Mock(return_value=1704067200))
+    current.Variables.side_effect = lambda i: mock.Mock(
+        Value=mock.Mock(return_value=values[i]))
+    return mock.Mock(Current=mock.Mock(return_value=current))
+
+
+def make_hourly_response(start, interval, series):
+    hourly = mock.Mock(
+        Time=mock.Mock(return_value=start),
+        Interval=mock.Mock(return_value=interval))
+    hourly.Variables.side_effect = lambda i: mock.Mock(
+        ValuesAsNumpy=mock.Mock(return_value=np.array(series[i])))
+    return mock.Mock(
+        Current=mock.Mock(return_value=None),
+        Hourly=mock.Mock(return_value=hourly))
+
+
+def temp_forecast_cache(slots=64, probes=8):
+    directory = tempfile.TemporaryDirectory()
+    cache = SharedForecastCache(
+        os.path.join(directory.name, 'forecast.cache'), slots, 0.05, probes)
+    cache.directory = directory
+    return cache
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
 
 
 class RegistrationFormTest(TestCase):
@@ -107,6 +188,15 @@ class AddCityFormTest(TestCase):
         self.assertEqual(City.objects.count(), 1)
         self.assertEqual(City.objects.get().name, 'Test City')
 
+    def test_existing_coordinates_reuse_city(self):
+        city = City.objects.create(name='Test City', latitude=45.0, longitude=90.0)
+        form = AddCityForm(data={
+            'name': 'Other', 'latitude': 45.004, 'longitude': 89.996})
+
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.save(), city)
+        self.assertEqual(City.objects.count(), 1)
+
     def test_invalid_latitude(self):
         form_data = {
             'name': 'Test City',
@@ -159,11 +249,13 @@ class DateRangeFormTest(TestCase):
         form_data = {
             'start_date': timezone.now().date() - timezone.timedelta(days=10),
             'end_date': timezone.now().date() - timezone.timedelta(days=9),
-            'cities': self.city.id,
+            'cities': [self.city.id],
             'parameters': ['temperature_2m', 'precipitation']
         }
         form = DateRangeForm(data=form_data, user=self.user)
         self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['resolution'], 1)
+        self.assertEqual(form.cleaned_data['aggregations'], ['mean'])
 
     def test_empty_fields(self):
         form_data = {
@@ -200,3 +292,1607 @@ class DateRangeFormTest(TestCase):
         form = DateRangeForm(data=form_data, user=self.user)
         self.assertFalse(form.is_valid())
         self.assertIn('__all__', form.errors)
+
+
+class FetchWeatherBatchTest(TestCase):
+
+    def setUp(self):
+        self.cities = [
+            City.objects.create(name='A', latitude=10.0, longitude=20.0),
+            City.objects.create(name='B', latitude=30.0, longitude=40.0),
+            City.objects.create(name='C', latitude=10.0, longitude=20.0),
+            City.objects.create(name='D', latitude=50.0, longitude=60.0),
+        ]
+
+    @mock.patch('main.batch.openmeteo', new_callable=mock.AsyncMock)
+    async def test_chunks_and_maps_back(self, openmeteo):
+        def weather_api(url, params):
+            return [make_response(float(lat))
+                    for lat in params['latitude'].split(',')]
+        openmeteo.weather_api.side_effect = weather_api
+
+        weather = await fetch_weather_batch(self.cities, batch_size=2)
+
+        self.assertEqual(openmeteo.weather_api.call_count, 2)
+        self.assertEqual(weather[self.cities[0].id]['temperature'], 10.0)
+        self.assertEqual(weather[self.cities[1].id]['temperature'], 30.0)
+        self.assertEqual(weather[self.cities[2].id]['temperature'], 10.0)
+        self.assertEqual(weather[self.cities[3].id]['temperature'], 50.0)
+
+    @mock.patch('main.batch.openmeteo', new_callable=mock.AsyncMock)
+    async def test_nearby_cities_share_request(self, openmeteo):
+        openmeteo.weather_api.return_value = [make_response(1.0)]
+        cities = [
+            City(id=101, name='E', latitude=55.75, longitude=37.61),
+            City(id=102, name='F', latitude=55.7512, longitude=37.6173),
+        ]
+
+        weather = await fetch_weather_batch(cities)
+
+        params = openmeteo.weather_api.call_args.kwargs['params']
+        self.assertNotIn(',', params['latitude'])
+        self.assertEqual(weather[cities[0].id], weather[cities[1].id])
+
+    @mock.patch('main.batch.openmeteo', new_callable=mock.AsyncMock)
+    async def test_failed_chunk_returns_none(self, openmeteo):
+        openmeteo.weather_api.side_effect = Exception('upstream')
+
+        weather = await fetch_weather_batch(self.cities)
+
+        self.assertTrue(all(data is None for data in weather.values()))
+
+
+class AsyncClientTest(TestCase):
+
+    def setUp(self):
+        cache = requests_cache.CachedSession(backend='memory').cache
+        self.client = AsyncClient(cache=cache)
+        message = b'\x00' * 8
+        self.body = len(message).to_bytes(4, 'little') + message
+
+    def test_encode_params(self):
+        params = encode_params({
+            'latitude': 55.75,
+            'hourly': ['temperature_2m', 'rain'],
+        })
+        self.assertEqual(params, {
+            'latitude': '55.75',
+            'hourly': 'temperature_2m,rain',
+            'format': 'flatbuffers',
+        })
+
+    async def test_cached_response_skips_network(self):
+        params = {'latitude': 55.75, 'longitude': 37.61}
+        with mock.patch.object(
+                self.client, '_request',
+                new=mock.AsyncMock(return_value=({}, self.body))) as request:
+            first = await self.client.weather_api('https://example.com', dict(params))
+            second = await self.client.weather_api('https://example.com', dict(params))
+
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(self.client.stats(), {
+            'hits': 1, 'misses': 1, 'coalesced': 0, 'hit_ratio': 0.5})
+
+
+class SingleFlightTest(TestCase):
+
+    async def test_concurrent_calls_share_one_flight(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'data'
+
+        results = await asyncio.gather(
+            *(flights.run(('url', ('a', '1')), fetch) for _ in range(5)))
+
+        self.assertEqual(results, ['data'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.started, 1)
+        self.assertEqual(flights.coalesced, 4)
+
+    async def test_error_is_shared_and_flight_released(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream')
+
+        results = await asyncio.gather(
+            flights.run('key', fail), flights.run('key', fail),
+            return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+        async def ok():
+            return 'data'
+
+        self.assertEqual(await flights.run('key', ok), 'data')
+
+
+class GridTest(TestCase):
+
+    def test_nearby_points_share_cell(self):
+        self.assertEqual(
+            snap_point(55.75, 37.61, step=0.05),
+            snap_point(55.7512, 37.6173, step=0.05))
+
+    def test_step_disabled(self):
+        self.assertEqual(snap(55.7512, step=0), 55.7512)
+
+    def test_snapped_values_are_rounded(self):
+        self.assertEqual(snap(0.3, step=0.1), 0.3)
+        self.assertEqual(snap(-37.6173, step=0.25), -37.5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WeatherSnapshotTest(TestCase):
+
+    def setUp(self):
+        self.fresh = City.objects.create(name='A', latitude=10.0, longitude=20.0)
+        self.stale = City.objects.create(name='B', latitude=30.0, longitude=40.0)
+        self.missing = City.objects.create(name='C', latitude=50.0, longitude=60.0)
+        WeatherSnapshot.objects.create(
+            city=self.fresh, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=timezone.now())
+        WeatherSnapshot.objects.create(
+            city=self.stale, temperature=4.0, wind_speed=5.0, pressure=6.0,
+            fetched_at=timezone.now() - timedelta(hours=1))
+
+    def load_cities(self):
+        return list(City.objects.select_related('snapshot').order_by('id'))
+
+    async def test_save_snapshots_upserts(self):
+        await asave_snapshots([self.fresh, self.missing], {
+            self.fresh.id: {
+                'temperature': np.float32(7.5), 'wind_speed': 1, 'pressure': 2},
+            self.missing.id: None,
+        })
+
+        self.assertEqual(await WeatherSnapshot.objects.acount(), 2)
+        self.assertEqual(
+            (await WeatherSnapshot.objects.aget(city=self.fresh)).temperature, 7.5)
+
+    @mock.patch('main.snapshots.fetch_weather_batch', new_callable=mock.AsyncMock)
+    async def test_latest_weather_serves_stale_and_revalidates(self, fetch):
+        fetch.side_effect = lambda cities, **kwargs: {
+            city.id: {'temperature': 9.0, 'wind_speed': 9.0, 'pressure': 9.0}
+            for city in cities}
+
+        weather = await latest_weather(await sync_to_async(self.load_cities)())
+
+        self.assertEqual(
+            [city.id for city in fetch.call_args_list[0].args[0]], [self.missing.id])
+        self.assertEqual(weather[self.fresh.id]['temperature'], 1.0)
+        self.assertNotIn('age', weather[self.fresh.id])
+        self.assertEqual(weather[self.stale.id]['temperature'], 4.0)
+        self.assertGreaterEqual(weather[self.stale.id]['age'], 3600)
+        self.assertEqual(weather[self.missing.id]['temperature'], 9.0)
+
+        await revalidator.wait()
+
+        self.assertEqual(
+            [city.id for city in fetch.call_args_list[1].args[0]], [self.stale.id])
+        snapshot = await WeatherSnapshot.objects.aget(city=self.stale)
+        self.assertEqual(snapshot.temperature, 9.0)
+        self.assertEqual(await WeatherSnapshot.objects.acount(), 3)
+
+    @mock.patch('main.live.get_channel_layer', return_value=None)
+    @mock.patch('main.snapshots.fetch_weather_batch', new_callable=mock.AsyncMock)
+    async def test_refresh_changes_only_followers_fragment_key(self, fetch, layer):
+        follower = await User.objects.acreate(username='follower')
+        other = await User.objects.acreate(username='other')
+        await UserCity.objects.acreate(user=follower, city=self.fresh)
+        await UserCity.objects.acreate(user=other, city=self.stale)
+        keys = [await fragment_key(user.id) for user in (follower, other)]
+        fetch.return_value = {
+            self.fresh.id: {'temperature': 8.0, 'wind_speed': 2.0, 'pressure': 3.0}}
+        cities = await sync_to_async(self.load_cities)()
+
+        await refresh_cities(cities[:1])
+
+        self.assertNotEqual(await fragment_key(follower.id), keys[0])
+        self.assertEqual(await fragment_key(other.id), keys[1])
+
+    @mock.patch('main.snapshots.fetch_weather_batch', new_callable=mock.AsyncMock)
+    async def test_latest_weather_falls_back_to_stale(self, fetch):
+        fetch.side_effect = lambda cities, **kwargs: {city.id: None for city in cities}
+        await WeatherSnapshot.objects.filter(city=self.stale).aupdate(
+            fetched_at=timezone.now() - timedelta(hours=7))
+
+        weather = await latest_weather(await sync_to_async(self.load_cities)())
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(weather[self.stale.id]['temperature'], 4.0)
+        self.assertGreaterEqual(weather[self.stale.id]['age'], 7 * 3600)
+        self.assertIsNone(weather[self.missing.id])
+
+
+class RefreshSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.cities = [
+            City(id=i, name=str(i), latitude=float(i), longitude=float(i))
+            for i in range(20)
+        ]
+
+    async def test_cycle_refreshes_every_city_once(self):
+        refreshed = []
+
+        async def load():
+            return self.cities
+
+        async def refresh(cities):
+            refreshed.extend(cities)
+            return len(cities)
+
+        scheduler = RefreshScheduler(load, refresh, interval=0.05, slots=5)
+        cycle = await scheduler.run_cycle()
+
+        self.assertEqual(sorted(city.id for city in refreshed), list(range(20)))
+        self.assertEqual(cycle['cities'], 20)
+        self.assertEqual(cycle['refreshed'], 20)
+        self.assertEqual(cycle['missed'], 0)
+        self.assertEqual(cycle['late_slots'], 0)
+        self.assertGreaterEqual(cycle['duration'], 0.05)
+
+    async def test_late_slot_counted_separately_from_missed(self):
+        async def load():
+            return self.cities
+
+        async def refresh(cities):
+            await asyncio.sleep(0.05)
+            return len(cities) - 1
+
+        scheduler = RefreshScheduler(load, refresh, interval=0.01, slots=1)
+        cycle = await scheduler.run_cycle()
+
+        self.assertEqual(cycle['refreshed'], 19)
+        self.assertEqual(cycle['missed'], 1)
+        self.assertEqual(cycle['late_slots'], 1)
+
+    def test_same_cell_shares_slot(self):
+        scheduler = RefreshScheduler(None, None, slots=30)
+        self.assertEqual(
+            scheduler.slot(City(latitude=55.75, longitude=37.61)),
+            scheduler.slot(City(latitude=55.7512, longitude=37.6173)))
+
+
+class LeaderLockTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'refresh.lock')
+
+    def test_only_one_leader(self):
+        first = FileLeaderLock(self.path)
+        second = FileLeaderLock(self.path)
+        self.addCleanup(first.release)
+        self.addCleanup(second.release)
+
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+
+        first.release()
+        self.assertTrue(second.try_acquire())
+
+    async def test_follower_takes_over(self):
+        leader = FileLeaderLock(self.path)
+        self.assertTrue(leader.try_acquire())
+
+        async def work():
+            return 'done'
+
+        follower = asyncio.ensure_future(run_as_leader(
+            work, FileLeaderLock(self.path), retry_interval=0.01))
+        await asyncio.sleep(0.05)
+        self.assertFalse(follower.done())
+
+        leader.release()
+        self.assertEqual(await follower, 'done')
+
+
+class TTLCacheTest(TestCase):
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl_expiry(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        with mock.patch('main.memcache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+        with mock.patch('main.memcache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    @mock.patch('main.views.forecast_cache', new_callable=lambda: temp_forecast_cache())
+    @mock.patch('main.views.last_good_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.memory_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.openmeteo', new_callable=mock.AsyncMock)
+    async def test_get_weather_data_uses_memory_tier(self, openmeteo, cache, last_good, shared):
+        openmeteo.weather_api.return_value = [make_response(5.0)]
+
+        first = await views.get_weather_data(55.75, 37.61)
+        second = await views.get_weather_data(55.7512, 37.6173)
+
+        self.assertEqual(openmeteo.weather_api.call_count, 1)
+        self.assertIs(first, second)
+        self.assertEqual(cache.hits, 1)
+
+
+class ParseLatestTest(TestCase):
+
+    def test_current_block(self):
+        self.assertEqual(parse_latest(make_response(3.0, 4.0, 5.0)), {
+            'temperature': 3.0, 'wind_speed': 4.0, 'pressure': 5.0})
+
+    def test_nearest_index(self):
+        times = np.array([0, 3600, 7200])
+        self.assertEqual(nearest_index(times, -100), 0)
+        self.assertEqual(nearest_index(times, 1000), 0)
+        self.assertEqual(nearest_index(times, 2000), 1)
+        self.assertEqual(nearest_index(times, 3600), 1)
+        self.assertEqual(nearest_index(times, 9000), 2)
+
+    def test_hourly_fallback_uses_nearest_hour(self):
+        response = make_hourly_response(0, 3600, [
+            [1.0, 2.0, 3.0], [4.0, 5.0, 6.0], [7.0, 8.0, 9.0]])
+
+        self.assertEqual(parse_latest(response, now=4000), {
+            'temperature': 2.0, 'wind_speed': 5.0, 'pressure': 8.0})
+
+
+class HourlyChunkCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = HourlyChunkCache(maxsize=100, ttl=60, recent_ttl=60)
+
+    def fake_series(self, cells, start_date, end_date, variables, url=None):
+        days = (end_date - start_date).days + 1
+        return [{
+            variable: np.arange(days * 24, dtype=np.float32)
+            + (start_date - date(2024, 1, 1)).days * 24 + cell[0] * 1000
+            for variable in variables
+        } for cell in cells]
+
+    @mock.patch('main.history.fetch_hourly', new_callable=mock.AsyncMock)
+    async def test_only_missing_chunks_are_fetched(self, fetch):
+        fetch.side_effect = self.fake_series
+
+        first = await load_hourly(
+            55.75, 37.61, date(2024, 1, 1), date(2024, 1, 2),
+            ['temperature_2m'], cache=self.cache, store=None)
+        self.assertEqual(len(first), 48)
+        self.assertEqual(fetch.call_count, 1)
+
+        wider = await load_hourly(
+            55.75, 37.61, date(2024, 1, 1), date(2024, 1, 3),
+            ['temperature_2m'], cache=self.cache, store=None)
+        self.assertEqual(fetch.call_args.args[1:], (
+            date(2024, 1, 3), date(2024, 1, 3), ['temperature_2m']))
+        self.assertEqual(
+            list(wider['temperature_2m']),
+            list(np.arange(72, dtype=np.float32) + 55750))
+
+        more = await load_hourly(
+            55.7512, 37.6173, date(2024, 1, 1), date(2024, 1, 3),
+            ['temperature_2m', 'rain'], cache=self.cache, store=None)
+        self.assertEqual(fetch.call_args.args[3], ['rain'])
+        self.assertEqual(list(more.columns), ['date', 'temperature_2m', 'rain'])
+        self.assertEqual(str(more['date'].iloc[0]), '2024-01-01 00:00:00+00:00')
+
+        await load_hourly(
+            55.75, 37.61, date(2024, 1, 2), date(2024, 1, 3),
+            ['rain'], cache=self.cache, store=None)
+        self.assertEqual(fetch.call_count, 3)
+
+
+class HistoryStoreTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = HistoryStore(directory.name)
+        self.cell = (55.75, 37.6)
+
+    def test_write_across_months_and_read(self):
+        values = np.arange(3 * 24, dtype=np.float32)
+        self.store.write(self.cell, 'rain', date(2024, 1, 31), values)
+
+        found = self.store.read(self.cell, 'rain', [
+            date(2024, 1, 30), date(2024, 1, 31), date(2024, 2, 1),
+            date(2024, 2, 2)])
+
+        self.assertEqual(sorted(found), [
+            date(2024, 1, 31), date(2024, 2, 1), date(2024, 2, 2)])
+        self.assertEqual(list(found[date(2024, 2, 1)]), list(values[24:48]))
+
+    def test_concurrent_writes_keep_all_days(self):
+        days = [date(2024, 1, day) for day in range(1, 17)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(
+                lambda day: self.store.write(
+                    self.cell, 'rain', day, np.full(24, day.day, dtype=np.float32)),
+                days))
+
+        found = self.store.read(self.cell, 'rain', days)
+
+        self.assertEqual(sorted(found), days)
+        self.assertEqual([found[day][0] for day in days], [day.day for day in days])
+
+    @mock.patch('main.history.fetch_hourly', new_callable=mock.AsyncMock)
+    async def test_old_days_come_from_archive_then_store(self, fetch):
+        fetch.side_effect = lambda cells, start, end, variables, url=None: [{
+            variable: np.ones(((end - start).days + 1) * 24, dtype=np.float32)
+            for variable in variables} for _ in cells]
+
+        await load_hourly(
+            55.75, 37.6, date(2024, 1, 1), date(2024, 1, 2), ['rain'],
+            cache=HourlyChunkCache(maxsize=10, ttl=60), store=self.store)
+        self.assertEqual(
+            fetch.call_args.kwargs['url'],
+            'https://archive-api.open-meteo.com/v1/archive')
+
+        frame = await load_hourly(
+            55.75, 37.6, date(2024, 1, 1), date(2024, 1, 2), ['rain'],
+            cache=HourlyChunkCache(maxsize=10, ttl=60), store=self.store)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(frame['rain'].sum(), 48)
+
+
+class StreamingTableTest(TestCase):
+
+    def setUp(self):
+        self.frame = pd.DataFrame({
+            'date': pd.date_range('2024-01-01', periods=5, freq='h', tz='UTC'),
+            'rain': np.array([0.0, 0.5, 1.0, np.nan, 2.0], dtype=np.float32),
+        })
+
+    def test_rows_are_chunked(self):
+        chunks = list(table_rows(self.frame, chunk_size=2))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(
+            chunks[0].splitlines()[1],
+            '<tr><td>2024-01-01 01:00:00+00:00</td><td>0.5</td></tr>')
+        self.assertEqual(sum(chunk.count('<tr>') for chunk in chunks), 5)
+
+    async def test_gzip_stream_round_trip(self):
+        async def chunks():
+            for chunk in ['<html>', 'строка' * 100, '</html>']:
+                yield chunk
+
+        data = b''.join([part async for part in gzip_stream(chunks())])
+
+        self.assertEqual(
+            zlib.decompress(data, 16 + zlib.MAX_WBITS).decode(),
+            '<html>' + 'строка' * 100 + '</html>')
+
+    @mock.patch('main.views.get_weather_comparison', new_callable=mock.AsyncMock)
+    async def test_city_weather_streams_table(self, get_weather_comparison):
+        aligned = self.frame.set_index('date')
+        aligned.columns = pd.MultiIndex.from_product(
+            [['A'], ['rain']], names=['city', 'variable'])
+        get_weather_comparison.return_value = aligned
+        user = await sync_to_async(User.objects.create_user)(
+            username='u', password='p')
+        city = await City.objects.acreate(name='A', latitude=1.0, longitude=2.0)
+        user_city = await UserCity.objects.acreate(user=user, city=city)
+        await self.async_client.aforce_login(user)
+
+        response = await self.async_client.post('/city_weather/', {
+            'start_date': timezone.now().date() - timedelta(days=3),
+            'end_date': timezone.now().date() - timedelta(days=2),
+            'cities': [user_city.id],
+            'parameters': ['rain'],
+        }, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = b''.join([part async for part in response.streaming_content])
+        html = zlib.decompress(data, 16 + zlib.MAX_WBITS).decode()
+        self.assertIn('<th>rain</th>', html)
+        self.assertEqual(html.count('<tr><td>'), 5)
+        self.assertTrue(html.rstrip().endswith('</html>'))
+
+
+class ResampleTest(TestCase):
+
+    def setUp(self):
+        self.frame = pd.DataFrame({
+            'date': pd.date_range('2024-01-01', periods=48, freq='h', tz='UTC'),
+            'rain': np.arange(48, dtype=np.float32),
+        })
+
+    def test_daily_aggregations(self):
+        daily = resample(self.frame, 24, ['min', 'max', 'sum'])
+
+        self.assertEqual(
+            list(daily.columns), ['date', 'rain_min', 'rain_max', 'rain_sum'])
+        self.assertEqual(list(daily['rain_min']), [0, 24])
+        self.assertEqual(list(daily['rain_max']), [23, 47])
+        self.assertEqual(list(daily['rain_sum']), [276, 852])
+        self.assertEqual(str(daily['date'][1]), '2024-01-02 00:00:00+00:00')
+
+    def test_partial_bucket_is_padded(self):
+        frame = self.frame.iloc[:10]
+        six_hourly = resample(frame, 6, ['mean'])
+
+        self.assertEqual(list(six_hourly['rain_mean']), [2.5, 7.5])
+
+    def test_lttb_keeps_endpoints_and_peak(self):
+        values = np.zeros((100, 1))
+        values[37] = 10.0
+        indices = lttb_indices(values, 10)
+
+        self.assertEqual(len(indices), 10)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], 99)
+        self.assertIn(37, indices)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+
+    def test_reduce_frame_bounds_points(self):
+        reduced = reduce_frame(self.frame, 1, ['mean'], target_points=12)
+
+        self.assertEqual(len(reduced), 12)
+        self.assertEqual(list(reduced.columns), ['date', 'rain'])
+
+
+class AlignedComparisonTest(TestCase):
+
+    @mock.patch('main.history.fetch_hourly', new_callable=mock.AsyncMock)
+    async def test_one_request_for_all_cities(self, fetch):
+        fetch.side_effect = lambda cells, start, end, variables, url=None: [{
+            variable: np.full(((end - start).days + 1) * 24, cell[0] + i,
+                              dtype=np.float32)
+            for i, variable in enumerate(variables)} for cell in cells]
+        cities = [
+            City(id=1, name='A', latitude=10.0, longitude=20.0),
+            City(id=2, name='B', latitude=30.0, longitude=40.0),
+            City(id=3, name='C', latitude=10.01, longitude=20.01),
+        ]
+
+        aligned = await load_aligned(
+            cities, date(2024, 1, 1), date(2024, 1, 2), ['rain', 'snowfall'],
+            cache=HourlyChunkCache(maxsize=100, ttl=60), store=None)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(len(fetch.call_args.args[0]), 2)
+        self.assertEqual(aligned.shape, (48, 6))
+        self.assertEqual(aligned[('B', 'snowfall')].iloc[0], 31.0)
+        self.assertEqual(aligned[('C', 'rain')].iloc[-1], 10.0)
+        self.assertEqual(aligned.index.name, 'date')
+
+        table = comparison_table(aligned)
+        self.assertEqual(list(table.columns)[:3], ['date', 'A: rain', 'A: snowfall'])
+
+    @mock.patch('main.history.fetch_hourly', new_callable=mock.AsyncMock)
+    async def test_repeated_labels_and_no_variables(self, fetch):
+        fetch.side_effect = lambda cells, start, end, variables, url=None: [{
+            variable: np.full(((end - start).days + 1) * 24, cell[0], dtype=np.float32)
+            for variable in variables} for cell in cells]
+        cities = [
+            City(id=1, name='Home', latitude=10.0, longitude=20.0),
+            City(id=2, name='Home', latitude=30.0, longitude=40.0),
+        ]
+        cache = HourlyChunkCache(maxsize=100, ttl=60)
+
+        aligned = await load_aligned(
+            cities, date(2024, 1, 1), date(2024, 1, 2), ['rain'],
+            cache=cache, store=None)
+        table = comparison_table(aligned)
+
+        self.assertEqual(list(table.columns), ['date', 'Home: rain', 'Home (2): rain'])
+        self.assertEqual(table['Home (2): rain'].iloc[0], 30.0)
+        self.assertEqual(
+            list(reduce_frame(table, 6, ['mean']).columns),
+            ['date', 'Home: rain_mean', 'Home (2): rain_mean'])
+
+        aligned = await load_aligned(
+            cities, date(2024, 1, 1), date(2024, 1, 2), [], cache=cache, store=None)
+        table = comparison_table(aligned)
+        self.assertEqual(list(table.columns), ['date'])
+        self.assertEqual(len(table), 48)
+        self.assertEqual(len(reduce_frame(table, 6, ['mean'])), 8)
+        self.assertEqual(''.join(table_rows(table)).count('<tr>'), 48)
+
+    def test_single_city_table_keeps_variable_names(self):
+        aligned = pd.DataFrame(
+            np.zeros((2, 1)),
+            index=pd.date_range('2024-01-01', periods=2, freq='h', name='date'),
+            columns=pd.MultiIndex.from_product(
+                [['A'], ['rain']], names=['city', 'variable']))
+
+        self.assertEqual(list(comparison_table(aligned).columns), ['date', 'rain'])
+
+
+class LiveWeatherTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='live', password='password')
+        self.city = City.objects.create(name='A', latitude=10.0, longitude=20.0)
+        self.other = City.objects.create(name='B', latitude=30.0, longitude=40.0)
+        UserCity.objects.create(user=self.user, city=self.city)
+
+    def connect(self, user):
+        communicator = ApplicationCommunicator(WeatherConsumer.as_asgi(), {
+            'type': 'websocket',
+            'path': '/ws/weather/',
+            'headers': [],
+            'subprotocols': [],
+            'user': user,
+        })
+        return communicator
+
+    async def test_pushes_only_changed_user_cities(self):
+        communicator = self.connect(self.user)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(
+            (await communicator.receive_output())['type'], 'websocket.accept')
+
+        now = timezone.now()
+        snapshots = [
+            WeatherSnapshot(city_id=self.city.id, temperature=1.0,
+                            wind_speed=2.0, pressure=3.0, fetched_at=now),
+            WeatherSnapshot(city_id=self.other.id, temperature=4.0,
+                            wind_speed=5.0, pressure=6.0, fetched_at=now),
+        ]
+        published = await publish_changes(changed_snapshots(snapshots, {
+            self.other.id: {'temperature': 0.0, 'wind_speed': 0.0, 'pressure': 0.0}}))
+
+        self.assertEqual(published, 2)
+        message = json.loads((await communicator.receive_output())['text'])
+        self.assertEqual(message['city'], self.city.id)
+        self.assertEqual(message['weather']['temperature'], 1.0)
+        self.assertTrue(await communicator.receive_nothing())
+
+        self.assertEqual(await publish_changes(changed_snapshots(
+            snapshots[:1], {self.city.id: snapshots[0].as_weather()})), 0)
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_rejects_anonymous(self):
+        communicator = self.connect(AnonymousUser())
+        await communicator.send_input({'type': 'websocket.connect'})
+
+        self.assertEqual(
+            (await communicator.receive_output())['type'], 'websocket.close')
+
+
+class WeatherApiTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='api', password='p')
+        self.city = City.objects.create(name='A', latitude=10.0, longitude=20.0)
+        UserCity.objects.create(user=self.user, city=self.city)
+        self.fetched_at = timezone.now().replace(microsecond=0)
+        WeatherSnapshot.objects.create(
+            city=self.city, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=self.fetched_at)
+        self.async_client.force_login(self.user)
+
+    async def test_city_current_conditional_get(self):
+        url = f'/api/cities/{self.city.id}/current/'
+
+        response = await self.async_client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['weather']['temperature'], 1.0)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = await self.async_client.get(
+            url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = await self.async_client.get(
+            url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        await WeatherSnapshot.objects.filter(city=self.city).aupdate(
+            temperature=5.0, fetched_at=self.fetched_at + timedelta(minutes=15))
+        response = await self.async_client.get(
+            url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @mock.patch('main.views.latest_weather', new_callable=mock.AsyncMock)
+    async def test_city_current_reports_stale_age(self, latest_weather):
+        url = f'/api/cities/{self.city.id}/current/'
+        response = await self.async_client.get(url)
+        self.assertFalse(response.has_header('Age'))
+
+        await WeatherSnapshot.objects.filter(city=self.city).aupdate(
+            fetched_at=self.fetched_at - timedelta(hours=1))
+        response = await self.async_client.get(url)
+
+        self.assertGreaterEqual(int(response['Age']), 3600)
+        self.assertNotIn('age', response.json()['weather'])
+
+    async def test_city_current_of_other_user(self):
+        other = await City.objects.acreate(name='B', latitude=1.0, longitude=2.0)
+
+        response = await self.async_client.get(f'/api/cities/{other.id}/current/')
+
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch('main.views.forecast_cache', new_callable=lambda: temp_forecast_cache())
+    @mock.patch('main.views.last_good_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.snapshot_index', new_callable=SnapshotIndex)
+    @mock.patch('main.views.memory_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.openmeteo', new_callable=mock.AsyncMock)
+    async def test_current_by_coordinates(self, openmeteo, cache, index, last_good, shared):
+        openmeteo.weather_api.return_value = [make_response(np.float32(7.25))]
+        started = datetime.now(dt_timezone.utc).replace(microsecond=0)
+
+        response = await self.async_client.get(
+            '/api/current/', {'latitude': '55,75', 'longitude': '37.61'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['weather']['temperature'], 7.25)
+        self.assertGreaterEqual(
+            parsedate_to_datetime(response['Last-Modified']), started)
+
+        response = await self.async_client.get(
+            '/api/current/', {'latitude': '10.0', 'longitude': '20.0'})
+        self.assertEqual(response.json()['weather']['temperature'], 1.0)
+        self.assertEqual(openmeteo.weather_api.call_count, 1)
+
+        for latitude in ('x', 'nan', 'inf', '1000'):
+            response = await self.async_client.get(
+                '/api/current/', {'latitude': latitude, 'longitude': '37.61'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('latitude', response.json()['errors'])
+        self.assertEqual(openmeteo.weather_api.call_count, 1)
+
+    @mock.patch('main.views.snapshot_index', new_callable=SnapshotIndex)
+    @mock.patch('main.views.get_latest', new_callable=mock.AsyncMock)
+    async def test_stale_current_keeps_etag(self, get_latest, index):
+        updated_at = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        weather = {'temperature': 1.0, 'wind_speed': 2.0, 'pressure': 3.0}
+        params = {'latitude': '55.75', 'longitude': '37.61'}
+
+        get_latest.return_value = (dict(weather, age=60), updated_at)
+        response = await self.async_client.get('/api/current/', params)
+        self.assertNotIn('age', response.json()['weather'])
+        self.assertEqual(response['Age'], '60')
+
+        get_latest.return_value = (dict(weather, age=61), updated_at)
+        second = await self.async_client.get(
+            '/api/current/', params, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['Age'], '61')
+
+    @mock.patch('main.views.memory_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.load_hourly', new_callable=mock.AsyncMock)
+    async def test_hourly_range(self, load, cache):
+        load.return_value = pd.DataFrame({
+            'date': pd.date_range('2024-01-01', periods=3, freq='h', tz='UTC'),
+            'rain': np.array([0.1, np.nan, 2.0], dtype=np.float32),
+        })
+        params = {
+            'latitude': 10.0, 'longitude': 20.0,
+            'start_date': '2024-01-01', 'end_date': '2024-01-02',
+            'parameters': ['rain'],
+        }
+
+        response = await self.async_client.get('/api/hourly/', params)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['hourly'], {
+            'date': ['2024-01-01T00:00:00+00:00', '2024-01-01T01:00:00+00:00',
+                     '2024-01-01T02:00:00+00:00'],
+            'rain': [0.1, None, 2.0],
+        })
+        response = await self.async_client.get(
+            '/api/hourly/', params, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        response = await self.async_client.get(
+            '/api/hourly/', dict(params, parameters=['unknown']))
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkWeatherTest(TestCase):
+
+    def test_parse_points_rejects_bad_payloads(self):
+        for body in [b'{', b'[]', b'{"points": 1}', b'[[1, 2], [3, 4], [5, 6]]']:
+            with self.assertRaises(ValueError):
+                parse_points(body, max_points=2)
+
+        self.assertEqual(
+            parse_points(b'{"points": [[1, 2]]}'), [[1, 2]])
+
+    @mock.patch('main.batch.openmeteo', new_callable=mock.AsyncMock)
+    async def test_dedupes_and_batches_points(self, openmeteo):
+        def weather_api(url, params):
+            return [make_response(float(lat))
+                    for lat in params['latitude'].split(',')]
+        openmeteo.weather_api.side_effect = weather_api
+        points = [
+            [10.0, 20.0],
+            {'latitude': 30.0, 'longitude': 40.0},
+            [10.001, 20.001],
+            [95.0, 0.0],
+            'x',
+        ]
+
+        lines = ''.join([line async for line in bulk_lines(points, batch_size=1)])
+        records = sorted(
+            (json.loads(line) for line in lines.splitlines()),
+            key=lambda record: record['index'])
+
+        self.assertEqual(openmeteo.weather_api.call_count, 2)
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[0]['weather']['temperature'], 10.0)
+        self.assertEqual(records[1]['weather']['temperature'], 30.0)
+        self.assertEqual(records[2]['latitude'], 10.001)
+        self.assertEqual(records[2]['weather'], records[0]['weather'])
+        self.assertIn('error', records[3])
+        self.assertIn('error', records[4])
+
+    @mock.patch('main.batch.openmeteo', new_callable=mock.AsyncMock)
+    async def test_endpoint_streams_ndjson(self, openmeteo):
+        openmeteo.weather_api.return_value = [make_response(1.0)]
+        user = await sync_to_async(User.objects.create_user)(
+            username='bulk', password='p')
+        await self.async_client.aforce_login(user)
+
+        response = await self.async_client.post(
+            '/api/bulk/', '[[10, 20]]', content_type='application/json')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join([part async for part in response.streaming_content])
+        self.assertEqual(json.loads(body)['weather']['temperature'], 1.0)
+
+        response = await self.async_client.post(
+            '/api/bulk/', 'nope', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get('/api/bulk/')
+        self.assertEqual(response.status_code, 405)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IndexFragmentTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='frag', password='p')
+        self.city = City.objects.create(name='A', latitude=10.0, longitude=20.0)
+        UserCity.objects.create(user=self.user, city=self.city)
+        self.async_client.force_login(self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    @mock.patch('main.views.latest_weather_partial', new_callable=mock.AsyncMock)
+    async def test_fragment_cached_until_invalidated(self, latest_weather):
+        latest_weather.side_effect = lambda cities, timeout: ({
+            city.id: {'temperature': 1.0, 'wind_speed': 2.0, 'pressure': 3.0}
+            for city in cities}, set())
+
+        first = await self.async_client.get('/')
+        second = await self.async_client.get('/')
+
+        self.assertEqual(latest_weather.call_count, 1)
+        self.assertContains(second, 'data-city-id')
+        self.assertEqual(first.content, second.content)
+
+        other = await City.objects.acreate(name='B', latitude=1.0, longitude=2.0)
+        await UserCity.objects.acreate(user=self.user, city=other)
+        response = await self.async_client.get('/')
+        self.assertEqual(latest_weather.call_count, 2)
+        self.assertContains(response, '<strong>B</strong>')
+
+        await WeatherSnapshot.objects.acreate(
+            city=self.city, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=timezone.now())
+        await self.async_client.get('/')
+        self.assertEqual(latest_weather.call_count, 3)
+
+        await UserCity.objects.filter(city=other).adelete()
+        response = await self.async_client.get('/')
+        self.assertEqual(latest_weather.call_count, 4)
+        self.assertNotContains(response, '<strong>B</strong>')
+
+    @mock.patch('main.signals.invalidate_user')
+    @mock.patch('main.views.latest_weather_partial', new_callable=mock.AsyncMock)
+    async def test_fragment_key_follows_user_cities(self, latest_weather, invalidate):
+        latest_weather.side_effect = lambda cities, timeout: ({
+            city.id: {'temperature': 1.0, 'wind_speed': 2.0, 'pressure': 3.0}
+            for city in cities}, set())
+        await self.async_client.get('/')
+
+        other = await City.objects.acreate(name='B', latitude=1.0, longitude=2.0)
+        await UserCity.objects.abulk_create([UserCity(user=self.user, city=other)])
+        response = await self.async_client.get('/')
+        self.assertContains(response, '<strong>B</strong>')
+
+        await UserCity.objects.filter(city=other).adelete()
+        response = await self.async_client.get('/')
+        self.assertNotContains(response, '<strong>B</strong>')
+        self.assertTrue(invalidate.called)
+
+    @mock.patch('main.views.latest_weather_partial', new_callable=mock.AsyncMock)
+    async def test_missing_weather_is_not_cached(self, latest_weather):
+        latest_weather.side_effect = lambda cities, timeout: ({
+            city.id: None for city in cities}, set())
+
+        await self.async_client.get('/')
+        await self.async_client.get('/')
+
+        self.assertEqual(latest_weather.call_count, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CityDeduplicationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create_user(username=f'user{i}', password='p')
+            for i in range(2)]
+
+    def test_find_city_across_cell_border(self):
+        city = City.objects.create(name='A', latitude=10.0049, longitude=20.0)
+
+        self.assertEqual(city.location_key, '10.0:20.0')
+        self.assertEqual(find_city(10.0051, 20.0), city)
+        self.assertIsNone(find_city(10.03, 20.0))
+
+    def test_group_duplicates(self):
+        cities = [
+            City(id=1, latitude=10.0, longitude=20.0),
+            City(id=2, latitude=30.0, longitude=40.0),
+            City(id=3, latitude=10.004, longitude=20.004),
+            City(id=4, latitude=10.02, longitude=20.0),
+        ]
+
+        self.assertEqual(group_duplicates(cities), {3: 1})
+
+    def test_merge_repoints_user_cities(self):
+        first = City.objects.create(name='A', latitude=10.0, longitude=20.0)
+        second = City.objects.create(name='B', latitude=10.001, longitude=20.001)
+        third = City.objects.create(name='C', latitude=10.002, longitude=20.0)
+        other = City.objects.create(name='D', latitude=30.0, longitude=40.0)
+        UserCity.objects.create(user=self.users[0], city=first)
+        UserCity.objects.create(user=self.users[0], city=second)
+        UserCity.objects.create(user=self.users[1], city=second)
+        UserCity.objects.create(user=self.users[1], city=third)
+        UserCity.objects.create(user=self.users[1], city=other)
+
+        call_command('merge_cities', '--dry-run', stdout=open(os.devnull, 'w'))
+        self.assertEqual(City.objects.count(), 4)
+
+        duplicates = merge_duplicates()
+
+        self.assertEqual(duplicates, {second.id: first.id, third.id: first.id})
+        self.assertEqual(
+            set(City.objects.values_list('id', flat=True)), {first.id, other.id})
+        self.assertEqual(
+            set(UserCity.objects.values_list('user_id', 'city_id')), {
+                (self.users[0].id, first.id),
+                (self.users[1].id, first.id),
+                (self.users[1].id, other.id)})
+        self.assertEqual(
+            UserCity.objects.get(user=self.users[1], city=first).label, 'B')
+
+    async def test_added_city_keeps_users_label(self):
+        moscow = await City.objects.acreate(
+            name='Moscow', latitude=55.75, longitude=37.61)
+        await UserCity.objects.acreate(user=self.users[1], city=moscow)
+        await WeatherSnapshot.objects.acreate(
+            city=moscow, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=timezone.now())
+        await sync_to_async(self.async_client.force_login)(self.users[0])
+
+        await self.async_client.post('/add_city/', {
+            'name': 'My Dacha', 'latitude': 55.7505, 'longitude': 37.6105})
+        user_city = await UserCity.objects.select_related('city').aget(
+            user=self.users[0])
+
+        self.assertEqual(user_city.city_id, moscow.id)
+        self.assertEqual(user_city.label, 'My Dacha')
+        response = await self.async_client.get('/')
+        self.assertContains(response, '<strong>My Dacha</strong>')
+        self.assertNotContains(response, 'Moscow')
+        response = await self.async_client.get(f'/api/cities/{moscow.id}/current/')
+        self.assertEqual(response.json()['city']['name'], 'My Dacha')
+
+    async def test_delete_deduplicated_city(self):
+        kazan = await City.objects.acreate(name='Kazan', latitude=55.79, longitude=49.12)
+        moscow = await City.objects.acreate(
+            name='Moscow', latitude=55.75, longitude=37.61)
+        for city in (kazan, moscow):
+            await UserCity.objects.acreate(user=self.users[1], city=city)
+        await sync_to_async(self.async_client.force_login)(self.users[0])
+        await self.async_client.post('/add_city/', {
+            'name': 'My Dacha', 'latitude': 55.7505, 'longitude': 37.6105})
+        user_city = await UserCity.objects.aget(user=self.users[0])
+        self.assertNotEqual(user_city.id, moscow.id)
+
+        with mock.patch('main.views.latest_weather_partial',
+                        new=mock.AsyncMock(return_value=({moscow.id: None}, set()))):
+            response = await self.async_client.get('/')
+        delete_url = f'/delete_city/{user_city.id}/'
+        self.assertContains(response, f'href="{delete_url}"')
+
+        response = await self.async_client.get(delete_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(await UserCity.objects.filter(user=self.users[0]).aexists())
+        self.assertTrue(await UserCity.objects.filter(user=self.users[1]).aexists())
+
+    async def test_refresh_loads_followed_cities_once(self):
+        city = await City.objects.acreate(name='A', latitude=1.0, longitude=2.0)
+        await City.objects.acreate(name='B', latitude=3.0, longitude=4.0)
+        for user in self.users:
+            await UserCity.objects.acreate(user=user, city=city)
+
+        self.assertEqual([city.id for city in await get_cities()], [city.id])
+
+
+class SnapshotIndexTest(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.index = SnapshotIndex(step=0.1, max_distance=5.0)
+
+    def add(self, city_id, latitude, longitude, temperature, age=0):
+        self.index.add(
+            city_id, latitude, longitude, {'temperature': temperature},
+            self.now - timedelta(seconds=age))
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(0, 0, 0, 1), 111.19, places=2)
+
+    def test_nearest_fresh_entry_within_distance(self):
+        self.add(1, 55.75, 37.61, 1.0)
+        self.add(2, 55.70, 37.61, 2.0)
+        self.add(3, 55.752, 37.62, 3.0, age=3600)
+        self.add(4, 56.5, 37.61, 4.0)
+
+        nearby = self.index.nearest(55.751, 37.615, now=self.now)
+
+        self.assertEqual(nearby['city_id'], 1)
+        self.assertLess(nearby['distance'], 1.0)
+        self.assertEqual(
+            self.index.nearest(55.69, 37.61, now=self.now)['city_id'], 2)
+        self.assertIsNone(self.index.nearest(56.2, 37.61, now=self.now))
+        self.assertEqual(
+            self.index.nearest(56.2, 37.61, max_distance=50, now=self.now)['city_id'], 4)
+
+    def test_nearest_across_bucket_border(self):
+        self.add(1, 10.149, 20.0, 1.0)
+
+        self.assertEqual(self.index.nearest(10.151, 20.0, now=self.now)['city_id'], 1)
+
+    def test_moved_city_and_prune(self):
+        self.add(1, 10.0, 20.0, 1.0)
+        self.add(1, 30.0, 40.0, 2.0)
+        self.add(2, 50.0, 60.0, 3.0, age=3600)
+
+        self.assertIsNone(self.index.nearest(10.0, 20.0, now=self.now))
+        self.assertEqual(self.index.prune(self.now - timedelta(minutes=1)), 1)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.buckets, {
+            (30.0, 40.0): {1: (30.0, 40.0, {'temperature': 2.0}, self.now)}})
+
+    async def test_sync_loads_new_snapshots(self):
+        city = await City.objects.acreate(name='A', latitude=10.0, longitude=20.0)
+        other = await City.objects.acreate(name='B', latitude=30.0, longitude=40.0)
+        await WeatherSnapshot.objects.acreate(
+            city=city, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=timezone.now())
+        await WeatherSnapshot.objects.acreate(
+            city=other, temperature=4.0, wind_speed=5.0, pressure=6.0,
+            fetched_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(await self.index.sync(), 1)
+        self.assertEqual(await self.index.sync(), 0)
+        await WeatherSnapshot.objects.filter(city=other).aupdate(
+            fetched_at=timezone.now())
+        self.assertEqual(await self.index.sync(force=True), 1)
+
+        self.assertEqual(self.index.nearest(10.01, 20.01)['weather']['temperature'], 1.0)
+        self.assertEqual(self.index.nearest(30.0, 40.0)['city_id'], other.id)
+
+    @mock.patch('main.views.get_weather_data', new_callable=mock.AsyncMock)
+    async def test_weather_view_uses_nearby_city(self, get_weather_data):
+        get_weather_data.return_value = {
+            'temperature': 9.0, 'wind_speed': 9.0, 'pressure': 9.0}
+        self.index.add(1, 55.75, 37.61, {
+            'temperature': 1.5, 'wind_speed': 2.0, 'pressure': 3.0}, self.now)
+        self.index.checked_at = time.monotonic()
+        user = await sync_to_async(User.objects.create_user)(
+            username='near', password='p')
+        await self.async_client.aforce_login(user)
+
+        with mock.patch('main.views.snapshot_index', self.index):
+            near = await self.async_client.get(
+                '/weather/', {'latitude': '55.76', 'longitude': '37.62'})
+            far = await self.async_client.get(
+                '/weather/', {'latitude': '10.0', 'longitude': '20.0'})
+
+        self.assertContains(near, 'Температура: 1,5')
+        self.assertContains(far, 'Температура: 9,0')
+        self.assertEqual(get_weather_data.call_count, 1)
+
+
+class UpstreamExecutorTest(TestCase):
+
+    async def hold(self, executor, lane, started, release):
+        async def work():
+            started.append(lane)
+            await release.wait()
+            return lane
+        return await executor.run(work, lane)
+
+    async def test_interactive_lane_goes_first(self):
+        executor = UpstreamExecutor(concurrency=1, reserved=0)
+        release = asyncio.Event()
+        started = []
+
+        first = asyncio.ensure_future(self.hold(executor, BACKGROUND, started, release))
+        await asyncio.sleep(0)
+        background = asyncio.ensure_future(
+            self.hold(executor, BACKGROUND, started, release))
+        interactive = asyncio.ensure_future(
+            self.hold(executor, INTERACTIVE, started, release))
+        await asyncio.sleep(0)
+
+        self.assertEqual(executor.stats()[BACKGROUND]['queued'], 1)
+        self.assertEqual(executor.stats()[INTERACTIVE]['queued'], 1)
+        release.set()
+        await asyncio.gather(first, background, interactive)
+
+        self.assertEqual(started, [BACKGROUND, INTERACTIVE, BACKGROUND])
+        self.assertEqual(executor.stats()[INTERACTIVE]['active'], 0)
+        self.assertGreaterEqual(executor.stats()[INTERACTIVE]['wait_max'], 0)
+
+    async def test_reserved_slots_and_queue_limit(self):
+        executor = UpstreamExecutor(
+            concurrency=2, reserved=1, max_queue=1, background_queue=1)
+        release = asyncio.Event()
+        started = []
+
+        tasks = [asyncio.ensure_future(self.hold(executor, BACKGROUND, started, release))
+                 for _ in range(2)]
+        await asyncio.sleep(0)
+        with self.assertRaises(UpstreamBusy):
+            await executor.run(mock.AsyncMock(), BACKGROUND)
+        tasks.append(asyncio.ensure_future(
+            self.hold(executor, INTERACTIVE, started, release)))
+        await asyncio.sleep(0)
+
+        self.assertEqual(started, [BACKGROUND, INTERACTIVE])
+        self.assertEqual(executor.stats()[BACKGROUND]['rejected'], 1)
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(executor.active, {INTERACTIVE: 0, BACKGROUND: 0})
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        executor = UpstreamExecutor(concurrency=1)
+        release = asyncio.Event()
+        started = []
+
+        first = asyncio.ensure_future(self.hold(executor, INTERACTIVE, started, release))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(
+            self.hold(executor, INTERACTIVE, started, release))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+        self.assertEqual(executor.stats()[INTERACTIVE]['queued'], 0)
+        release.set()
+        await first
+        self.assertEqual(executor.active[INTERACTIVE], 0)
+
+    def test_use_lane(self):
+        with use_lane(BACKGROUND):
+            self.assertEqual(upstream_lane.get(), BACKGROUND)
+        self.assertEqual(upstream_lane.get(), INTERACTIVE)
+
+    @mock.patch('main.views.snapshot_index', new_callable=SnapshotIndex)
+    @mock.patch('main.views.get_latest', new_callable=mock.AsyncMock)
+    async def test_api_returns_503_when_busy(self, get_latest, index):
+        get_latest.side_effect = UpstreamBusy()
+        user = await sync_to_async(User.objects.create_user)(
+            username='busy', password='p')
+        await self.async_client.aforce_login(user)
+
+        response = await self.async_client.get(
+            '/api/current/', {'latitude': '1', 'longitude': '2'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+
+        response = await self.async_client.get(
+            '/weather/', {'latitude': '1', 'longitude': '2'})
+        self.assertEqual(response.status_code, 503)
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(
+            failure_threshold=2, cooldown=30, clock=lambda: self.now)
+
+    def test_opens_and_probes_after_cooldown(self):
+        self.breaker.check()
+        self.breaker.record_failure()
+        self.breaker.check()
+        self.breaker.record_failure()
+
+        with self.assertRaises(CircuitOpen):
+            self.breaker.check()
+
+        self.now = 31.0
+        self.breaker.check()
+        with self.assertRaises(CircuitOpen):
+            self.breaker.check()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.now = 62.0
+        self.breaker.check()
+        self.breaker.record_success()
+        self.breaker.check()
+        self.assertEqual(self.breaker.stats(), {
+            'state': 'closed', 'failures': 0, 'opened': 2, 'rejected': 2})
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+
+        self.breaker.check()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def status_session(self, status):
+        response = mock.Mock(status=status)
+        response.json = mock.AsyncMock(return_value={'reason': 'error'})
+        response.raise_for_status.side_effect = aiohttp.ClientResponseError(
+            mock.Mock(), (), status=status)
+        context = mock.MagicMock()
+        context.__aenter__ = mock.AsyncMock(return_value=response)
+        context.__aexit__ = mock.AsyncMock(return_value=False)
+        return mock.Mock(get=mock.Mock(return_value=context))
+
+    async def test_5xx_and_429_open_circuit(self):
+        for status, error in ((503, aiohttp.ClientResponseError),
+                              (429, OpenMeteoRequestsError)):
+            breaker = CircuitBreaker(failure_threshold=2, cooldown=30)
+            client = AsyncClient(retries=0, backoff_factor=0, breaker=breaker)
+            with mock.patch.object(
+                    client, 'session', return_value=self.status_session(status)):
+                for latitude in (1, 2):
+                    with self.assertRaises(error):
+                        await client.weather_api(
+                            'https://example.com', {'latitude': latitude})
+            self.assertEqual(breaker.state, 'open')
+
+    async def test_bad_request_is_not_a_failure(self):
+        client = AsyncClient(retries=0, backoff_factor=0, breaker=self.breaker)
+        with mock.patch.object(client, 'session', return_value=self.status_session(400)):
+            for latitude in (1, 2):
+                with self.assertRaises(OpenMeteoRequestsError):
+                    await client.weather_api('https://example.com', {'latitude': latitude})
+        self.assertEqual(self.breaker.state, 'closed')
+
+    async def test_open_circuit_stops_retry_chain(self):
+        client = AsyncClient(retries=5, backoff_factor=0, breaker=self.breaker)
+        session = mock.Mock()
+        session.get.side_effect = aiohttp.ClientConnectionError('down')
+
+        with mock.patch.object(client, 'session', return_value=session):
+            with use_lane(BACKGROUND), self.assertRaises(CircuitOpen):
+                await client.weather_api('https://example.com', {'latitude': 1})
+
+        self.assertEqual(session.get.call_count, 2)
+
+    async def test_interactive_lane_limits_retries_and_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=10, cooldown=30)
+        client = AsyncClient(retries=5, backoff_factor=0, timeout=30,
+                             interactive_retries=1, interactive_timeout=5,
+                             breaker=breaker)
+        session = mock.Mock()
+        session.get.side_effect = asyncio.TimeoutError()
+
+        with mock.patch.object(client, 'session', return_value=session):
+            with use_lane(INTERACTIVE), self.assertRaises(asyncio.TimeoutError):
+                await client.weather_api('https://example.com', {'latitude': 1})
+            self.assertEqual(session.get.call_count, 2)
+            self.assertEqual(session.get.call_args.kwargs['timeout'].total, 5)
+
+            with use_lane(BACKGROUND), self.assertRaises(asyncio.TimeoutError):
+                await client.weather_api('https://example.com', {'latitude': 2})
+            self.assertEqual(session.get.call_count, 8)
+            self.assertEqual(session.get.call_args.kwargs['timeout'].total, 30)
+
+    @mock.patch('main.views.forecast_cache', new_callable=lambda: temp_forecast_cache())
+    @mock.patch('main.views.last_good_cache', new_callable=lambda: TTLCache(8, 3600))
+    @mock.patch('main.views.memory_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.openmeteo', new_callable=mock.AsyncMock)
+    async def test_get_latest_serves_last_good_value(self, openmeteo, cache, last_good, shared):
+        openmeteo.weather_api.return_value = [make_response(5.0)]
+        latest, fetched_at = await views.get_latest(55.75, 37.61)
+        last_good.set(('latest', 55.75, 37.6), (latest, fetched_at - timedelta(minutes=5)))
+        cache._data.clear()
+        shared.clear()
+        openmeteo.weather_api.side_effect = CircuitOpen()
+
+        weather, updated_at = await views.get_latest(55.75, 37.61)
+        await revalidator.wait()
+
+        self.assertEqual(weather['temperature'], 5.0)
+        self.assertGreaterEqual(weather['age'], 300)
+        self.assertEqual(openmeteo.weather_api.call_count, 2)
+        self.assertIsNone(cache.get(('latest', 55.75, 37.6)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DeadlineIndexTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='slow', password='p')
+        self.fast = City.objects.create(name='Fast', latitude=10.0, longitude=20.0)
+        self.slow = City.objects.create(name='Slow', latitude=30.0, longitude=40.0)
+        WeatherSnapshot.objects.create(
+            city=self.fast, temperature=1.0, wind_speed=2.0, pressure=3.0,
+            fetched_at=timezone.now())
+        for city in (self.fast, self.slow):
+            UserCity.objects.create(user=self.user, city=city)
+        self.async_client.force_login(self.user)
+        self.release = asyncio.Event()
+
+    def tearDown(self):
+        cache.clear()
+
+    async def slow_fetch(self, cities, **kwargs):
+        await self.release.wait()
+        return {city.id: {'temperature': 5.0, 'wind_speed': 6.0, 'pressure': 7.0}
+                for city in cities}
+
+    @mock.patch('main.snapshots.fetch_weather_batch')
+    async def test_partial_results_after_deadline(self, fetch):
+        fetch.side_effect = self.slow_fetch
+        cities = await sync_to_async(list)(
+            City.objects.select_related('snapshot').order_by('id'))
+
+        weather, pending = await latest_weather_partial(cities, timeout=0.01)
+
+        self.assertEqual(weather[self.fast.id]['temperature'], 1.0)
+        self.assertIsNone(weather[self.slow.id])
+        self.assertEqual(pending, {self.slow.id})
+
+        self.release.set()
+        await revalidator.wait()
+        self.assertTrue(await WeatherSnapshot.objects.filter(city=self.slow).aexists())
+
+    @mock.patch('main.views.INDEX_DEADLINE', 0.01)
+    @mock.patch('main.snapshots.fetch_weather_batch')
+    async def test_index_renders_placeholders_and_tiles(self, fetch):
+        fetch.side_effect = self.slow_fetch
+
+        response = await self.async_client.get('/')
+        tile_url = f'/city_tile/{self.slow.id}/'
+
+        self.assertContains(response, f'data-tile-url="{tile_url}"')
+        self.assertContains(response, '<span data-field="temperature">1,0</span>')
+        self.assertEqual(await cache.aget(await fragment_key(self.user.id)), None)
+
+        with mock.patch('main.views.TILE_DEADLINE', 0.01):
+            response = await self.async_client.get(tile_url)
+        self.assertEqual(response.status_code, 202)
+
+        self.release.set()
+        await revalidator.wait()
+        response = await self.async_client.get(tile_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<span data-field="temperature">5,0</span>')
+        self.assertNotContains(response, 'data-tile-url')
+
+        other = await City.objects.acreate(name='Other', latitude=1.0, longitude=2.0)
+        response = await self.async_client.get(f'/city_tile/{other.id}/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class AsyncOrmViewsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='async', email='async@example.com', password='secret')
+        self.city = City.objects.create(name='Moscow', latitude=55.75, longitude=37.62)
+        self.user_city = UserCity.objects.create(user=self.user, city=self.city)
+
+    def tearDown(self):
+        cache.clear()
+
+    async def test_registration_checks_taken_names(self):
+        form = RegistrationForm(data={
+            'username': 'async', 'email': 'async@example.com', 'password': 'p'})
+        self.assertFalse(await form.ais_valid())
+        self.assertEqual(form.errors['username'],
+                         [RegistrationForm.taken_messages['username']])
+        self.assertEqual(form.errors['email'],
+                         [RegistrationForm.taken_messages['email']])
+
+        response = await self.async_client.post('/registration/', {
+            'username': 'new', 'email': 'new@example.com', 'password': 'p'})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        user = await User.objects.aget(username='new')
+        self.assertTrue(user.check_password('p'))
+        self.assertEqual(
+            await sync_to_async(lambda: self.async_client.session['_auth_user_id'])(),
+            str(user.id))
+
+    async def test_login_and_logout(self):
+        response = await self.async_client.post(
+            '/login/', {'username': 'async', 'password': 'wrong'})
+        self.assertContains(response, 'Неправильное имя пользователя или пароль')
+
+        response = await self.async_client.post(
+            '/login/', {'username': 'async', 'password': 'secret'})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        response = await self.async_client.get('/weather/')
+        self.assertEqual(response.status_code, 200)
+
+        await self.async_client.get('/logout/')
+        response = await self.async_client.get('/weather/')
+        self.assertEqual(response.status_code, 302)
+
+    async def test_add_and_delete_city(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+
+        response = await self.async_client.post('/add_city/', {
+            'name': 'Moscow again', 'latitude': 55.7501, 'longitude': 37.6201})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(await City.objects.acount(), 1)
+        self.assertEqual(await UserCity.objects.acount(), 1)
+
+        await self.async_client.post('/add_city/', {
+            'name': 'Kazan', 'latitude': 55.79, 'longitude': 49.12})
+        self.assertTrue(await UserCity.objects.filter(
+            user=self.user, city__name='Kazan').aexists())
+
+        response = await self.async_client.get(f'/delete_city/{self.user_city.id}/')
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(await UserCity.objects.filter(id=self.user_city.id).aexists())
+        response = await self.async_client.get(f'/delete_city/{self.user_city.id}/')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_date_range_form_uses_prefetched_cities(self):
+        other = await User.objects.acreate(username='other')
+        foreign = await UserCity.objects.acreate(user=other, city=self.city)
+        data = {'start_date': '2024-01-01', 'end_date': '2024-01-02'}
+
+        form = DateRangeForm(dict(data, cities=[self.user_city.id]), user=self.user)
+        self.assertTrue(await form.ais_valid())
+        self.assertEqual(form.cleaned_data['cities'][0].city.name, 'Moscow')
+
+        form = DateRangeForm(dict(data, cities=[foreign.id]), user=self.user)
+        self.assertFalse(await form.ais_valid())
+        self.assertIn('cities', form.errors)
+
+
+class SharedForecastCacheTest(TestCase):
+
+    def setUp(self):
+        self.writer = temp_forecast_cache()
+        self.reader = SharedForecastCache(self.writer.path, 64, 0.05)
+        self.updated_at = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+    def test_readers_see_writes_through_mapped_file(self):
+        self.assertIsNone(self.reader.get(55.75, 37.61))
+
+        self.writer.set(55.75, 37.61, {
+            'temperature': 1.5, 'wind_speed': None, 'pressure': 1000.0},
+            self.updated_at, now=100.0)
+        (weather, updated_at), age = self.reader.get(55.7512, 37.6173, now=130.0)
+
+        self.assertEqual(weather, {
+            'temperature': 1.5, 'wind_speed': None, 'pressure': 1000.0})
+        self.assertEqual(updated_at, self.updated_at)
+        self.assertEqual(age, 30.0)
+        self.assertIsNone(self.reader.get(55.75, 37.61, max_age=10, now=130.0))
+        self.assertEqual(self.reader.stats()['size'], 1)
+
+    def test_overwrites_cell_and_evicts_oldest_probe(self):
+        cache = temp_forecast_cache(slots=2, probes=2)
+        for now, latitude in enumerate([10.0, 20.0, 30.0], start=1):
+            cache.set(latitude, 0.0, {'temperature': latitude}, self.updated_at, now=now)
+        cache.set(30.0, 0.0, {'temperature': 31.0}, self.updated_at, now=4)
+
+        self.assertIsNone(cache.get(10.0, 0.0))
+        self.assertEqual(cache.get(20.0, 0.0)[0][0]['temperature'], 20.0)
+        self.assertEqual(cache.get(30.0, 0.0)[0][0]['temperature'], 31.0)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_skips_entry_being_written(self):
+        self.writer.set(55.75, 37.61, {'temperature': 1.0}, self.updated_at)
+        index = self.writer.positions(cell_of(55.75, 37.61, 0.05))[0]
+        self.writer.table['seq'][index] += 1
+
+        self.assertIsNone(self.reader.get(55.75, 37.61))
+        self.assertGreater(self.reader.retries, 0)
+
+        self.writer.table['seq'][index] += 1
+        self.assertEqual(self.reader.get(55.75, 37.61)[0][0]['temperature'], 1.0)
+
+    def test_write_recovers_slot_left_odd(self):
+        self.writer.set(55.75, 37.61, {'temperature': 1.0}, self.updated_at)
+        index = self.writer.positions(cell_of(55.75, 37.61, 0.05))[0]
+        self.writer.table['seq'][index] += 1
+
+        self.writer.set(55.75, 37.61, {'temperature': 2.0}, self.updated_at)
+
+        self.assertEqual(self.writer.table['seq'][index] % 2, 0)
+        self.assertEqual(self.reader.get(55.75, 37.61)[0][0]['temperature'], 2.0)
+
+    @mock.patch('main.views.memory_cache', new_callable=lambda: TTLCache(8, 60))
+    @mock.patch('main.views.openmeteo', new_callable=mock.AsyncMock)
+    async def test_get_latest_reads_other_worker_entry(self, openmeteo, cache):
+        self.writer.set(55.75, 37.6, {
+            'temperature': 4.0, 'wind_speed': 2.0, 'pressure': 990.0},
+            self.updated_at)
+
+        with mock.patch('main.views.forecast_cache', self.reader):
+            weather, updated_at = await views.get_latest(55.7512, 37.6173)
+            await views.get_latest(55.75, 37.61)
+
+        self.assertEqual(weather['temperature'], 4.0)
+        self.assertEqual(updated_at, self.updated_at)
+        self.assertEqual(openmeteo.weather_api.call_count, 0)
+        self.assertEqual(self.reader.hits, 1)
+        self.assertEqual(cache.hits, 1)
+
+
+class BackfillHistoryCommandTest(TestCase):
+
+    def test_rejects_bad_dates(self):
+        for option in ('--start', '--end'):
+            with self.assertRaises(CommandError):
+                call_command('backfill_history', option, '2024-13-01')
+
+    @mock.patch('main.management.commands.backfill_history.openmeteo',
+                new_callable=mock.AsyncMock)
+    @mock.patch('main.management.commands.backfill_history.store_history',
+                new_callable=mock.AsyncMock)
+    def test_closes_client_inside_event_loop(self, store_history, openmeteo):
+        store_history.side_effect = RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            call_command('backfill_history', '--start', '2024-01-01',
+                         '--end', '2024-01-02', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(
+            store_history.call_args.args[1:], (date(2024, 1, 1), date(2024, 1, 2)))
+        openmeteo.close.assert_awaited_once()
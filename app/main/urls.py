@@ -29,4 +29,10 @@ urlpatterns = [
     path('registration/', views.registration, name='registration'),
     path('login/', views.myLogin, name='login'),
     path('logout/', views.myLogout, name='logout'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('city_tile/<int:city_id>/', views.city_tile, name='city_tile'),
+    path('api/current/', views.api_current, name='api_current'),
+    path('api/cities/<int:city_id>/current/', views.api_city_current, name='api_city_current'),
+    path('api/hourly/', views.api_hourly, name='api_hourly'),
+    path('api/bulk/', views.api_bulk, name='api_bulk'),
 ]
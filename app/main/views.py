@@ -1,58 +1,103 @@
-from .forms import RegistrationForm, LoginForm, AddCityForm, DateRangeForm
-from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth import authenticate, login, logout
-from django.contrib.auth.decorators import login_required
-from .config import openmeteo, setup_logging
+from .forms import (RegistrationForm, LoginForm, AddCityForm, DateRangeForm,
+                    HourlyQueryForm, CoordinatesForm)
+from django.shortcuts import render, redirect, aget_object_or_404
+from django.template.loader import render_to_string
+from django.contrib.auth import aauthenticate, alogin, alogout
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
+from .config import (openmeteo, memory_cache, last_good_cache, forecast_cache,
+                     setup_logging, FORECAST_URL, UPSTREAM_RETRY_AFTER,
+                     INDEX_DEADLINE, TILE_DEADLINE, CACHE_EXPIRE, STALE_MAX_AGE)
+from .revalidate import revalidator
+from .batch import parse_latest, latest_params
+from .snapshots import (latest_weather, latest_weather_partial, to_float,
+                        is_fresh, snapshot_age)
+from .conditional import conditional_json
+from .bulk import parse_points, bulk_lines
+from .fragments import fragment_key, get_fragment, set_fragment
+from .spatial import snapshot_index
+from .executor import UpstreamBusy
+from .history import load_hourly, load_aligned, comparison_table, history_cache
+from .streaming import stream_table
+from .resample import reduce_frame
+from .tasks import scheduler
+from .grid import snap_point
 from asgiref.sync import sync_to_async
-from django.contrib.auth import login
-from .models import UserCity
-import pandas as pd
-import asyncio
+from .models import UserCity, WeatherSnapshot
+from datetime import datetime, timezone
 import logging
+import numpy as np
 
 setup_logging()
 logger = logging.getLogger(__name__)
 
-
-async def fetch_weather_data(city):
-    try:
-        logger.info(f"Получение данных о погоде для города: {city.name}")
-        weather_data = await get_weather_data(city.latitude, city.longitude)
-        return city.name, {
-            "weather": weather_data,
-            "city": city
-        }
-    except Exception as e:
-        logger.error(
-            f"Ошибка при получении данных о погоде для города {
-                city.name}: {e}")
-        return city.name, None
+BUSY_MESSAGE = "Сервис погоды перегружен, попробуйте позже."
 
 
 async def index(request):
     logger.debug(f"Запрос index")
+    user = await request.auser()
+
+    cities_html = None
+    if user.is_authenticated:
+        cities_html = await render_user_cities(user)
 
-    @sync_to_async
-    def get_user_cities(user):
-        if user.is_authenticated:
-            return list(
-                UserCity.objects.filter(
-                    user=user).select_related('city'))
-        return []
-    user_cities = await get_user_cities(request.user)
+    user_data = {
+        'user': user,
+        'cities_html': cities_html}
+
+    html = await sync_to_async(render)(request, 'index.html', user_data)
+
+    return html
 
-    tasks = [fetch_weather_data(user_city.city) for user_city in user_cities]
-    results = await asyncio.gather(*tasks)
+
+async def render_user_cities(user):
+    key = await fragment_key(user.id)
+    cities_html = await get_fragment(key)
+    if cities_html is not None:
+        return cities_html
+
+    user_cities = [user_city async for user_city in UserCity.objects.filter(
+        user=user).select_related('city', 'city__snapshot')]
+
+    cities = [user_city.city for user_city in user_cities]
+    weather, pending = await latest_weather_partial(cities, INDEX_DEADLINE)
 
     cities_weather_data = {
-        name: data for name, data in results if data is not None
+        user_city.label: {
+            "weather": weather[user_city.city_id],
+            "city": user_city.city,
+            "user_city": user_city,
+            "pending": user_city.city_id in pending
+        }
+        for user_city in user_cities
     }
-    user_data = {
-        'user': request.user,
-        "cities_weather_data": cities_weather_data}
-    
-    html = await sync_to_async(render)(request, 'index.html', user_data)
+    cities_html = await sync_to_async(render_to_string)(
+        'index_cities.html', {"cities_weather_data": cities_weather_data})
+
+    if not pending and all(
+            data is not None and 'age' not in data for data in weather.values()):
+        await set_fragment(key, cities_html)
+    return cities_html
+
 
+@login_required
+async def city_tile(request, city_id):
+    user = await request.auser()
+    user_city = await UserCity.objects.select_related(
+        'city', 'city__snapshot').filter(user=user, city_id=city_id).afirst()
+    if user_city is None:
+        raise Http404("Город не найден.")
+
+    city = user_city.city
+    weather, pending = await latest_weather_partial([city], TILE_DEADLINE)
+    html = await sync_to_async(render)(request, 'city_tile.html', {
+        'city': city,
+        'user_city': user_city,
+        'weather': weather[city.id],
+        'pending': city.id in pending,
+    }, status=202 if pending else 200)
     return html
 
 
@@ -61,15 +106,15 @@ async def registration(request):
 
     if request.method == 'POST':
         form = RegistrationForm(request.POST)
-        if await sync_to_async(form.is_valid)():
-            user = await sync_to_async(form.save)(commit=False)
+        if await form.ais_valid():
+            user = form.save(commit=False)
             user.set_password(form.cleaned_data['password'])
-            await sync_to_async(user.save)()
-            await sync_to_async(login)(request, user)
+            await user.asave()
+            await alogin(request, user)
             logger.info(f"Пользователь {user.username} зарегистрирован.")
             return redirect('main:index')
     else:
-        form = await sync_to_async(RegistrationForm)()
+        form = RegistrationForm()
 
     html = await sync_to_async(render)(request, 'registration.html', {'form': form})
     return html
@@ -80,14 +125,14 @@ async def myLogin(request):
 
     if request.method == 'POST':
         form = LoginForm(request.POST)
-        if await sync_to_async(form.is_valid)():
+        if form.is_valid():
             username = form.cleaned_data['username']
             password = form.cleaned_data['password']
 
-            user = await sync_to_async(authenticate)(request, username=username, password=password)
+            user = await aauthenticate(request, username=username, password=password)
 
             if user is not None:
-                await sync_to_async(login)(request, user)
+                await alogin(request, user)
                 logger.info(f"Пользователь {username} вошел в систему.")
                 return redirect('main:index')
             else:
@@ -95,20 +140,17 @@ async def myLogin(request):
                     None, "Неправильное имя пользователя или пароль")
                 logger.warning(f"Неудачная попытка входа {username}.")
     else:
-        form = await sync_to_async(LoginForm)()
+        form = LoginForm()
 
     html = await sync_to_async(render)(request, 'login.html', {'form': form})
     return html
 
 
 async def myLogout(request):
-    @sync_to_async
-    def get_username(request):
-        return request.user.username if request.user.is_authenticated else None
-
-    username = await get_username(request)
+    user = await request.auser()
+    username = user.username if user.is_authenticated else None
 
-    await sync_to_async(logout)(request)
+    await alogout(request)
 
     logger.info(f"Пользователь {username} вышел.")
     return redirect('main:index')
@@ -120,6 +162,13 @@ async def weather_view(request):
     wind_speed = None
     pressure = None
     error = None
+    age = None
+    status = 200
+
+    user = await request.auser()
+    user_cities = [user_city async for user_city in UserCity.objects.filter(
+        user=user).select_related('city')]
+    cities = {user_city.label: user_city.city for user_city in user_cities}
 
     if request.method == 'GET':
         latitude = request.GET.get('latitude')
@@ -140,32 +189,38 @@ async def weather_view(request):
             try:
                 logger.info(
                     f"Получение данных о погоде для координат: {latitude}, {longitude}")
-                weather_data = await get_weather_data(latitude, longitude)
+                await snapshot_index.sync()
+                nearby = snapshot_index.nearest(latitude, longitude)
+                if nearby is not None:
+                    weather_data = nearby['weather']
+                else:
+                    weather_data = await get_weather_data(latitude, longitude)
 
                 temperature = weather_data['temperature']
                 wind_speed = weather_data['wind_speed']
                 pressure = weather_data['pressure']
+                age = weather_data.get('age')
 
                 if temperature is None:
                     error = "Не удалось получить данные о погоде."
+            except UpstreamBusy:
+                logger.warning("Очередь запросов к Open-Meteo переполнена")
+                error = BUSY_MESSAGE
+                status = 503
             except Exception as e:
                 logger.error(f"Ошибка при получении данных о погоде: {e}")
                 error = "Произошла ошибка при получении данных о погоде."
         elif error is None:
             error = 'Пожалуйста, укажите широту и долготу.'
 
-    user_cities = user_cities = await sync_to_async(
-        lambda: list(UserCity.objects.filter(user=request.user).select_related('city'))
-    )()
-    cities = {user_city.city.name: user_city.city for user_city in user_cities}
-
     html = await sync_to_async(render)(request, 'weather.html', {
         'temperature': temperature,
         'wind_speed': wind_speed,
         'pressure': pressure,
+        'age': age,
         'error': error,
         'cities': cities,
-    })
+    }, status=status)
 
     return html
 
@@ -175,13 +230,15 @@ async def add_city(request):
     form = None
     if request.method == 'POST':
         form = AddCityForm(request.POST)
-        if await sync_to_async(form.is_valid)():
-            city = await sync_to_async(form.save)()
-            await sync_to_async(UserCity.objects.get_or_create)(user=request.user, city=city)
+        if form.is_valid():
+            user = await request.auser()
+            city = await form.asave()
+            name = form.cleaned_data['name']
+            await UserCity.objects.aget_or_create(
+                user=user, city=city, defaults={'name': name})
             logger.info(
                 f"Пользователь {
-                    request.user.username} добавил город: {
-                    city.name}.")
+                    user.username} добавил город: {name}.")
             return redirect('main:index')
     else:
         form = AddCityForm()
@@ -193,85 +250,281 @@ async def add_city(request):
 @login_required
 async def delete_city(request, city_id):
     if request.method == 'GET':
-        user_city = await sync_to_async(get_object_or_404)(UserCity, id=city_id, user=request.user)
-        await sync_to_async(user_city.delete)()
+        user = await request.auser()
+        user_city = await aget_object_or_404(UserCity, id=city_id, user=user)
+        await user_city.adelete()
         logger.info(
             f"Пользователь {
-                request.user.username} удалил город с ID: {city_id}.")
+                user.username} удалил город с ID: {city_id}.")
     return redirect('main:index')
 
 
 @login_required
 async def city_weather(request):
-    async def get_date_range_form(data, user):
-        return await sync_to_async(DateRangeForm)(data, user=user)
-
-    form = await get_date_range_form(None, request.user)
+    user = await request.auser()
+    form = DateRangeForm(None, user=user)
+    status = 200
     if request.method == 'POST':
-        form = await sync_to_async(DateRangeForm)(request.POST, user=request.user)
-        if await sync_to_async(form.is_valid)():
+        form = DateRangeForm(request.POST, user=user)
+        if await form.ais_valid():
             start_date = form.cleaned_data['start_date']
             end_date = form.cleaned_data['end_date']
             selected_cities = form.cleaned_data['cities']
             selected_parameters = form.cleaned_data['parameters']
+            cities = [user_city.city for user_city in selected_cities]
+            names = [user_city.label for user_city in selected_cities]
 
             logger.debug(
                 f"Пользователь {
-                    request.user.username} запрашивает погоду для города: " f"{
-                    selected_cities.city.name} с {start_date} по {end_date} для параметров: {selected_parameters}")
+                    user.username} запрашивает погоду для городов: " f"{
+                    names} с {start_date} по {end_date} для параметров: {selected_parameters}")
 
             try:
-                hourly_dataframe = await get_weather_parameters(
-                    selected_cities.city.latitude,
-                    selected_cities.city.longitude,
+                aligned = await get_weather_comparison(
+                    cities,
                     start_date,
                     end_date,
-                    selected_parameters
+                    selected_parameters,
+                    names
                 )
-                context = {
-                    'form': form,
-                    'hourly_dataframe': hourly_dataframe,
-                }
+                hourly_dataframe = comparison_table(aligned)
+                hourly_dataframe = reduce_frame(
+                    hourly_dataframe,
+                    form.cleaned_data['resolution'],
+                    form.cleaned_data['aggregations'],
+                    form.cleaned_data['target_points'])
                 logger.info("Данные о погоде успешно получены.")
-                return await sync_to_async(render)(request, 'city_weather.html', context)
+                return await stream_table(
+                    request, 'city_weather.html', {'form': form}, hourly_dataframe)
 
+            except UpstreamBusy:
+                logger.warning("Очередь запросов к Open-Meteo переполнена")
+                form.add_error(None, BUSY_MESSAGE)
+                status = 503
             except Exception as e:
                 logger.error(f"Ошибка при получении данных о погоде: {e}")
                 form.add_error(
                     None,
                     "Произошла ошибка при получении данных о погоде. Пожалуйста, попробуйте еще раз.")
 
-    html = await sync_to_async(render)(request, 'city_weather.html', {'form': form})
+    html = await sync_to_async(render)(
+        request, 'city_weather.html', {'form': form}, status=status)
     return html
 
 
-async def get_weather_data(latitude, longitude):
-    logger.debug(
-        f"Запрос параметров погоды для координат: ({latitude}, {longitude})")
-    url = "https://api.open-meteo.com/v1/forecast"
+async def get_weather_comparison(
+        cities,
+        start_date,
+        end_date,
+        selected_parameters,
+        names=None):
+    logger.debug(f"Запрос параметров погоды для {len(cities)} городов "
+                 f"с {start_date} по {end_date} для параметров: {selected_parameters}")
+
+    try:
+        aligned = await load_aligned(
+            cities, start_date, end_date, selected_parameters, names=names)
+        logger.debug(f"Данные о погоде успешно получены: {aligned.shape}")
+        return aligned
+
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных о погоде: {e}")
+        raise
+
+
+def api_error(message, status):
+    return JsonResponse({"error": message}, status=status)
+
+
+def busy_response():
+    response = api_error(BUSY_MESSAGE, 503)
+    response["Retry-After"] = str(UPSTREAM_RETRY_AFTER)
+    return response
 
-    params = {
+
+def weather_payload(weather):
+    return {key: to_float(value) for key, value in weather.items()}
+
+
+def frame_payload(frame):
+    payload = {"date": [value.isoformat() for value in frame['date']]}
+    for column in frame.columns.drop('date'):
+        values = np.round(frame[column].to_numpy(dtype=float), 2)
+        payload[column] = [
+            None if np.isnan(value) else float(value) for value in values]
+    return payload
+
+
+@login_required
+async def api_city_current(request, city_id):
+    user = await request.auser()
+    user_city = await UserCity.objects.select_related(
+        'city', 'city__snapshot').filter(
+        user=user, city_id=city_id).afirst()
+    if user_city is None:
+        return api_error("Город не найден.", 404)
+
+    city = user_city.city
+    await latest_weather([city])
+    snapshot = await WeatherSnapshot.objects.filter(city=city).afirst()
+    if snapshot is None:
+        return api_error("Не удалось получить данные о погоде.", 502)
+
+    return conditional_json(request, {
+        "city": {
+            "id": city.id,
+            "name": user_city.label,
+            "latitude": city.latitude,
+            "longitude": city.longitude,
+        },
+        "weather": weather_payload(snapshot.as_weather()),
+        "updated_at": snapshot.fetched_at,
+    }, snapshot.fetched_at,
+        age=None if is_fresh(snapshot) else snapshot_age(snapshot))
+
+
+@login_required
+async def api_current(request):
+    form = CoordinatesForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    latitude = form.cleaned_data['latitude']
+    longitude = form.cleaned_data['longitude']
+
+    await snapshot_index.sync()
+    nearby = snapshot_index.nearest(latitude, longitude)
+
+    if nearby is not None:
+        weather, updated_at = nearby['weather'], nearby['fetched_at']
+    else:
+        try:
+            weather, updated_at = await get_latest(latitude, longitude)
+        except UpstreamBusy:
+            return busy_response()
+        except Exception as e:
+            logger.error(
+                f"Ошибка при получении данных для координат {latitude}, {longitude}: {e}")
+            return api_error("Не удалось получить данные о погоде.", 502)
+
+    weather = dict(weather)
+    age = weather.pop('age', None)
+    latitude, longitude = snap_point(latitude, longitude)
+    return conditional_json(request, {
         "latitude": latitude,
         "longitude": longitude,
-        "hourly": "temperature_2m,wind_speed_10m,pressure_msl"
-    }
+        "weather": weather_payload(weather),
+        "updated_at": updated_at,
+    }, updated_at, age=age)
+
 
+@login_required
+async def api_hourly(request):
+    form = HourlyQueryForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    data = form.cleaned_data
     try:
-        responses = await asyncio.to_thread(openmeteo.weather_api, url, params=params)
+        frame = await get_weather_parameters(
+            data['latitude'],
+            data['longitude'],
+            data['start_date'],
+            data['end_date'],
+            data['parameters'])
+    except UpstreamBusy:
+        return busy_response()
+    except Exception:
+        return api_error("Не удалось получить данные о погоде.", 502)
+
+    latitude, longitude = snap_point(data['latitude'], data['longitude'])
+    return conditional_json(request, {
+        "latitude": latitude,
+        "longitude": longitude,
+        "start_date": data['start_date'],
+        "end_date": data['end_date'],
+        "hourly": frame_payload(frame),
+    })
 
-        response = responses[0]
-        hourly = response.Hourly()
 
-        latest_data = {
-            "temperature": hourly.Variables(0).ValuesAsNumpy()[-1],
-            "wind_speed": hourly.Variables(1).ValuesAsNumpy()[-1],
-            "pressure": hourly.Variables(2).ValuesAsNumpy()[-1],
-        }
+@login_required
+@require_POST
+async def api_bulk(request):
+    try:
+        points = parse_points(request.body)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    logger.info(f"Пакетный запрос погоды для {len(points)} точек")
+    return StreamingHttpResponse(
+        bulk_lines(points), content_type="application/x-ndjson")
+
+
+@user_passes_test(lambda user: user.is_staff)
+async def metrics(request):
+    return JsonResponse({
+        "memory": memory_cache.stats(),
+        "shared": forecast_cache.stats(),
+        "history": history_cache.stats(),
+        "upstream": openmeteo.stats(),
+        "refresh": scheduler.last_cycle,
+        "queue": openmeteo.executor.stats(),
+        "breaker": openmeteo.breaker.stats(),
+    })
+
+
+async def get_latest(latitude, longitude):
+    latitude, longitude = snap_point(latitude, longitude)
+    key = ("latest", latitude, longitude)
+    cached = memory_cache.get(key)
+    if cached is not None:
+        return cached
+
+    shared = forecast_cache.get(latitude, longitude, STALE_MAX_AGE)
+    if shared is not None:
+        latest, stored_age = shared
+        if stored_age < CACHE_EXPIRE:
+            memory_cache.set(key, latest, CACHE_EXPIRE - stored_age)
+            return latest
+
+    stale = last_good_cache.get(key)
+    if stale is None and shared is not None:
+        stale = shared[0]
+    if stale is not None:
+        revalidator.schedule(
+            [(latitude, longitude)], lambda point: ("latest",) + point,
+            lambda points: fetch_latest(*points[0]))
+        latest_data, updated_at = stale
+        age = int((datetime.now(timezone.utc) - updated_at).total_seconds())
+        return dict(latest_data, age=age), updated_at
+
+    return await fetch_latest(latitude, longitude)
+
+
+async def fetch_latest(latitude, longitude):
+    key = ("latest", latitude, longitude)
+    params = latest_params(latitude, longitude)
+    responses = await openmeteo.weather_api(FORECAST_URL, params=params)
+    latest = (parse_latest(responses[0]), datetime.now(timezone.utc))
+    memory_cache.set(key, latest)
+    last_good_cache.set(key, latest)
+    forecast_cache.set(latitude, longitude, *latest)
+    return latest
+
+
+async def get_weather_data(latitude, longitude):
+    logger.debug(
+        f"Запрос параметров погоды для координат: ({latitude}, {longitude})")
+
+    try:
+        latest_data, _ = await get_latest(latitude, longitude)
 
         logger.debug(
             f"Данные получены для координат: {latitude}, {longitude}")
         return latest_data
 
+    except UpstreamBusy:
+        raise
     except Exception as e:
         logger.error(
             f"Ошибка при получении данных для координат {latitude}, {longitude}: {e}")
@@ -287,31 +540,17 @@ async def get_weather_parameters(
     logger.debug(f"Запрос параметров погоды для координат: ({latitude}, {longitude}) "
                  f"с {start_date} по {end_date} для параметров: {selected_parameters}")
 
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "hourly": selected_parameters,
-        "start_date": start_date,
-        "end_date": end_date
-    }
+    latitude, longitude = snap_point(latitude, longitude)
+    key = ("hourly", latitude, longitude, str(start_date), str(end_date),
+           tuple(selected_parameters))
+    cached = memory_cache.get(key)
+    if cached is not None:
+        return cached
 
     try:
-        responses = await asyncio.to_thread(openmeteo.weather_api, url, params=params)
-        response = responses[0]
-        hourly = response.Hourly()
-
-        hourly_data = {"date": pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
-            inclusive="left"
-        )}
-
-        for i, param in enumerate(selected_parameters):
-            hourly_data[param] = hourly.Variables(i).ValuesAsNumpy()
-
-        hourly_dataframe = pd.DataFrame(data=hourly_data)
+        hourly_dataframe = await load_hourly(
+            latitude, longitude, start_date, end_date, selected_parameters)
+        memory_cache.set(key, hourly_dataframe)
         logger.debug(f"Данные о погоде успешно получены: {hourly_dataframe}")
         return hourly_dataframe
 